@@ -0,0 +1,67 @@
+"""
+Measures how long it takes to import telematrix and to build a bridge.
+
+Usage: python benchmarks/startup.py [runs]
+"""
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+CONFIG = {
+    'tokens': {'hs': 'hs', 'as': 'as', 'telegram': '123:abc'},
+    'hosts': {'internal': 'http://127.0.0.1:8008/',
+              'external': 'https://example.com/',
+              'bare': 'example.com'},
+    'user_id_format': '@telegram_{}:example.com',
+    'db_url': 'sqlite://',
+}
+
+
+def time_import(runs):
+    """Time a cold `import telematrix` in a fresh interpreter."""
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.check_call([sys.executable, '-c', 'import telematrix'],
+                              cwd=ROOT)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def time_startup(runs):
+    """Time building (and closing) a bridge from an in-memory config."""
+    from telematrix import Bridge
+    from telematrix.config import Config
+
+    loop = asyncio.new_event_loop()
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        bridge = Bridge(Config(CONFIG), loop)
+        bridge.make_app()
+        timings.append(time.perf_counter() - start)
+        loop.run_until_complete(bridge.close())
+    loop.close()
+    return timings
+
+
+def report(name, timings):
+    timings = sorted(timings)
+    print('{:<8} min {:8.2f} ms  median {:8.2f} ms'
+          .format(name, timings[0] * 1000,
+                  timings[len(timings) // 2] * 1000))
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    report('import', time_import(runs))
+    report('startup', time_startup(runs))
+
+
+if __name__ == '__main__':
+    main()
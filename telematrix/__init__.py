@@ -7,56 +7,26 @@ import asyncio
 import html
 import json
 import logging
-import mimetypes
+import signal
+from collections import Counter
 from datetime import datetime
+from functools import partial
 from time import time
 from urllib.parse import unquote, quote, urlparse, parse_qs
 from io import BytesIO
 import re
 
-from PIL import Image
 from aiohttp import web, ClientSession
 from aiotg import Bot
-from bs4 import BeautifulSoup
 
 import telematrix.database as db
-
-# Read the configuration file
-try:
-    with open('config.json', 'r') as config_file:
-        CONFIG = json.load(config_file)
-
-        HS_TOKEN = CONFIG['tokens']['hs']
-        AS_TOKEN = CONFIG['tokens']['as']
-        TG_TOKEN = CONFIG['tokens']['telegram']
-
-        try:
-            GOOGLE_TOKEN = CONFIG['tokens']['google']
-        except KeyError:
-            GOOGLE_TOKEN = None
-
-        MATRIX_HOST = CONFIG['hosts']['internal']
-        MATRIX_HOST_EXT = CONFIG['hosts']['external']
-        MATRIX_HOST_BARE = CONFIG['hosts']['bare']
-
-        MATRIX_PREFIX = MATRIX_HOST + '_matrix/client/r0/'
-        MATRIX_MEDIA_PREFIX = MATRIX_HOST + '_matrix/media/r0/'
-
-        USER_ID_FORMAT = CONFIG['user_id_format']
-        DATABASE_URL = CONFIG['db_url']
-
-        AS_PORT = CONFIG['as_port'] if 'as_port' in CONFIG else 5000
-except (OSError, IOError) as exception:
-    print('Error opening config file:')
-    print(exception)
-    exit(1)
-
-GOO_GL_URL = 'https://www.googleapis.com/urlshortener/v1/url'
-
-TG_BOT = Bot(api_token=TG_TOKEN)
-MATRIX_SESS = ClientSession()
-SHORTEN_SESS = ClientSession()
-
+from telematrix.config import Config, ConfigError
+from telematrix.backfill import Backfill
+from telematrix.cache import LRUCache
+from telematrix.lifecycle import Lifecycle
+from telematrix.links import create_shortener
+from telematrix.media import MediaCache
+from telematrix.scheduler import Scheduler, QueueFull, POLICIES
 
 def create_response(code, obj):
     """
@@ -78,6 +48,10 @@ def sanitize_html(string):
     :param string: The HTML string to sanitized.
     :return: The sanitized HTML string.
     """
+    # BeautifulSoup is only needed for formatted messages, so don't pay for
+    # importing it at startup.
+    from bs4 import BeautifulSoup
+
     string = string.replace('<br>', '\n').replace('<br/>', '\n') \
                    .replace('<br />', '\n')
     soup = BeautifulSoup(string, 'html.parser')
@@ -89,56 +63,23 @@ def sanitize_html(string):
     return soup.renderContents().decode('utf-8')
 
 
-def format_matrix_msg(form, content):
+def format_matrix_msg(form, content, host_bare):
     """
     Formats a matrix message for sending to Telegram
     :param form: The format string of the message, where the first parameter
                  is the username and the second one the message.
     :param content: The content to be sent.
+    :param host_bare: The bare domain of the homeserver.
     :return: The formatted string.
     """
     if 'format' in content and content['format'] == 'org.matrix.custom.html':
-        sanitized = re.sub("<a href=\\\"https://matrix.to/#/@telegram_([0-9]+):{}\\\">(.+?) \(Telegram\)</a>".format(MATRIX_HOST_BARE), "<a href=\"tg://user?id=\\1\">\\2</a>", content['formatted_body'])
+        sanitized = re.sub("<a href=\\\"https://matrix.to/#/@telegram_([0-9]+):{}\\\">(.+?) \(Telegram\)</a>".format(host_bare), "<a href=\"tg://user?id=\\1\">\\2</a>", content['formatted_body'])
         sanitized = sanitize_html(sanitized)
         return html.escape(form).format(sanitized), 'HTML'
     else:
         return form.format(html.escape(content['body'])), None
 
 
-async def download_matrix_file(url, filename):
-    """
-    Download a file from an MXC URL to /tmp/{filename}
-    :param url: The MXC URL to download from.
-    :param filename: The filename in /tmp/ to download into.
-    """
-    m_url = MATRIX_MEDIA_PREFIX + 'download/{}{}'.format(url.netloc, url.path)
-    async with MATRIX_SESS.get(m_url) as response:
-        data = await response.read()
-    with open('/tmp/{}'.format(filename), 'wb') as file:
-        file.write(data)
-
-
-async def shorten_url(url):
-    """
-    Shorten an URL using goo.gl. Returns the original URL if it fails.
-    :param url: The URL to shorten.
-    :return: The shortened URL.
-    """
-    if not GOOGLE_TOKEN:
-        return url
-
-    headers = {'Content-Type': 'application/json'}
-    async with SHORTEN_SESS.post(GOO_GL_URL, params={'key': GOOGLE_TOKEN},
-                                 data=json.dumps({'longUrl': url}),
-                                 headers=headers) \
-            as response:
-        obj = await response.json()
-
-    if 'id' in obj:
-        return obj['id']
-    else:
-        return url
-
 def matrix_is_telegram(user_id):
     username = user_id.split(':')[0][1:]
     return username.startswith('telegram_')
@@ -146,6 +87,33 @@ def matrix_is_telegram(user_id):
 def get_username(user_id):
     return user_id.split(':')[0][1:]
 
+def tg_displayname(tg_user):
+    name = tg_user['first_name']
+    if 'last_name' in tg_user:
+        name += ' ' + tg_user['last_name']
+    return name + ' (Telegram)'
+
+def is_unknown_file(error):
+    """
+    Whether an error from the Telegram API means that a file ID is invalid,
+    e.g. "Bad Request: wrong file identifier/HTTP URL specified".
+    """
+    message = str(error).lower()
+    return any(part in message for part in ('file identifier', 'file id',
+                                            'file_id', 'file reference'))
+
+def shared(loop, fun):
+    """
+    Wrap a coroutine function without arguments so that it runs at most once,
+    and every caller awaits the same result.
+    """
+    task = []
+    def wrapper():
+        if not task:
+            task.append(asyncio.ensure_future(fun(), loop=loop))
+        return task[0]
+    return wrapper
+
 mime_extensions = {
     'image/jpeg': 'jpg',
     'image/gif': 'gif',
@@ -156,162 +124,448 @@ mime_extensions = {
     'image/x-windows-bmp': 'bmp'
 }
 
-async def matrix_transaction(request):
+
+class Bridge:
     """
-    Handle a transaction sent by the homeserver.
-    :param request: The request containing the transaction.
-    :return: The response to send.
+    A single bridge instance. Holds the configuration, HTTP sessions,
+    database session and Telegram bot, so several bridges can run in one
+    process.
     """
-    body = await request.json()
-    events = body['events']
-    for event in events:
-        if 'age' in event and event['age'] > 600000:
-            print('discarded event of age', event['age'])
-            continue
-        try:
-            print('{}: <{}> {}'.format(event['room_id'], event['user_id'], event['type']))
-        except KeyError:
-            pass
+    # pylint: disable=too-many-public-methods
+
+    def __init__(self, config, loop=None):
+        self.config = config
+        self.loop = loop or asyncio.get_event_loop()
+
+        self.session = db.create_session(config.database_url)
+        self.bot = Bot(api_token=config.tg_token)
+        self.matrix_sess = ClientSession(loop=self.loop)
+        self.shortener = create_shortener(config, self.session)
+        self.media_links = LRUCache(config.link_cache_size)
+        self.media = MediaCache(self.session, config.media_cache_size)
+        self.backfill = Backfill(self, config.max_event_age,
+                                 config.catch_up_page_size,
+                                 config.catch_up_max_pages,
+                                 config.catch_up_threshold,
+                                 config.catch_up_stale_delay)
+        self.lifecycle = Lifecycle(self, config.shutdown_timeout)
+        self.scheduler = Scheduler(self.loop, config.queue_workers,
+                                   config.queue_size, config.queue_weight,
+                                   config.queue_policy)
+        self._bad_policies = set()
+
+        tracked = self.lifecycle.tracked
+        self.bot.handle('sticker')(tracked(self.queued(self.aiotg_sticker)))
+        self.bot.handle('photo')(tracked(self.queued(self.aiotg_photo)))
+        self.bot.command(r'/alias')(tracked(self.aiotg_alias))
+        self.bot.command(r'(?s)(.*)')(tracked(self.queued(self.aiotg_message)))
+
+    def start(self):
+        """
+        Start polling Telegram and running queued work, and catch up on
+        Matrix events missed while the bridge was down. Missed Telegram
+        messages are fetched by polling, as Telegram keeps them until they
+        are confirmed.
+        """
+        self.lifecycle.start(self.bot.loop())
+        for _ in range(self.scheduler.workers):
+            self.lifecycle.start(self.scheduler.worker())
+        if self.config.catch_up:
+            self.lifecycle.start(self.backfill.catch_up())
+
+    def is_bridged(self, event):
+        """Whether a Matrix event has already been bridged to Telegram."""
+        return self.session.query(db.Message)\
+                   .filter_by(matrix_event_id=event['event_id']).first() is not None
+
+    def is_own_event(self, event):
+        """Whether a Matrix event was caused by the bridge itself."""
+        user_id = event.get('state_key') if event['type'] == 'm.room.member' \
+            else event.get('sender', event.get('user_id'))
+        return bool(user_id) and (matrix_is_telegram(user_id)
+                                  or user_id == self.backfill.user_id)
+
+    def matrix_displayname(self, user_id):
+        """The last known display name of a Matrix user."""
+        sender = self.session.query(db.MatrixUser)\
+                     .filter_by(matrix_id=user_id).first()
+        return (sender and sender.name) or get_username(user_id)
+
+    def queue_options(self, link):
+        """
+        The queue settings of a link, falling back to the configured defaults.
+        :param link: The ChatLink.
+        :return: The keyword arguments for the scheduler.
+        """
+        policy = link.queue_policy
+        if policy and policy not in POLICIES:
+            if link.id not in self._bad_policies:
+                self._bad_policies.add(link.id)
+                print('Unknown queue policy {} for {}, using {}'
+                      .format(policy, link.matrix_room, self.config.queue_policy))
+            policy = None
+        return {'size': link.queue_size, 'weight': link.queue_weight,
+                'policy': policy}
+
+    def queued(self, handler):
+        """
+        Wrap a Telegram handler so that it runs on the chat's queue.
+        :param handler: The handler, taking a chat and one more argument.
+        :return: A handler that queues the original one.
+        """
+        async def enqueue(chat, arg):
+            link = self.session.query(db.ChatLink).filter_by(tg_room=chat.id).first()
+            if not link:
+                print('Unknown telegram chat {}: {}'.format(chat, chat.id))
+                return
+
+            try:
+                self.scheduler.submit(chat.id, partial(handler, chat, arg),
+                                      **self.queue_options(link))
+            except QueueFull:
+                # Telegram doesn't redeliver updates, so this one is lost.
+                print('Queue for {} is full, dropping message {}'
+                      .format(chat.id, chat.message['message_id']))
+        return enqueue
+
+    def make_app(self):
+        """
+        Create the aiohttp application serving the homeserver API.
+        :return: A web.Application.
+        """
+        app = web.Application(loop=self.loop)
+        app['bridge'] = self
+        app.router.add_route('GET', '/rooms/{room_alias}', self.matrix_room)
+        app.router.add_route('PUT', '/transactions/{transaction}',
+                             self.lifecycle.tracked(self.matrix_transaction))
+        app.router.add_route('GET', '/_telematrix/stats', self.bridge_stats)
+        self.shortener.add_routes(app)
+        app.on_cleanup.append(self.close)
+        return app
+
+    async def close(self, _app=None):
+        """Close the HTTP sessions and the database session."""
+        self.matrix_sess.close()
+        self.session.close()
+
+    async def download_matrix_file(self, url):
+        """
+        Download a file from an MXC URL.
+        :param url: The MXC URL to download from.
+        :return: The contents of the file.
+        """
+        m_url = self.config.matrix_media_prefix + \
+            'download/{}{}'.format(url.netloc, url.path)
+        async with self.matrix_sess.get(m_url) as response:
+            return await response.read()
 
-        if event['type'] == 'm.room.aliases' and event['state_key'] == MATRIX_HOST_BARE:
-            aliases = event['content']['aliases']
+    async def media_link(self, mxc_url):
+        """
+        Get a (shortened) external link to the media behind an MXC URL.
+        Links are remembered per MXC URL, so repeated media are shortened
+        only once.
+        :param mxc_url: The parsed MXC URL.
+        :return: The link.
+        """
+        key = mxc_url.geturl()
+        link = self.media_links.get(key)
+        if link is None:
+            link = self.config.matrix_host_ext + \
+                   '_matrix/media/r0/download/{}{}' \
+                   .format(mxc_url.netloc, quote(mxc_url.path))
+            link = await self.shortener.shorten(link)
+            self.media_links.put(key, link)
+        return link
+
+    async def send_matrix_image(self, group, content, caption, download):
+        """
+        Send an image from Matrix to a Telegram chat. Images Telegram already
+        has are sent by their file ID instead of being uploaded again.
+        :param group: The Telegram chat to send to.
+        :param content: The content of the m.image event.
+        :param caption: The caption of the photo.
+        :param download: A function returning an awaitable of the image data,
+                         shared by all chats the image is sent to.
+        :return: The response of the Telegram API.
+        """
+        file_id = self.media.file_id(content['url'])
+        if file_id:
+            try:
+                return await group.send_photo(file_id, caption=caption)
+            except RuntimeError as e:
+                # Other errors are about this chat, e.g. the bot was kicked,
+                # so the file ID still works for the others.
+                if not is_unknown_file(e):
+                    raise
+                print('Telegram no longer knows file {}: {}'.format(file_id, e))
+                self.media.forget(file_id)
+
+        # Append the correct extension if it's missing or wrong
+        ext = mime_extensions[content['info']['mimetype']]
+        filename = content['body']
+        if not filename.endswith(ext):
+            filename += '.' + ext
+
+        img_file = BytesIO(await download())
+        img_file.name = filename
+        response = await group.send_photo(img_file, caption=caption)
+
+        # The photo is sent at this point, so a failure to remember it must
+        # not lose the response.
+        try:
+            photo = response['result']['photo'][-1]
+            self.media.add(content['url'], photo['file_id'],
+                           content['info'].get('size'))
+        except Exception as e:  # pylint: disable=broad-except
+            print('Could not remember the Telegram file of {}: {}'
+                  .format(content['url'], e))
+        return response
+
+    async def matrix_transaction(self, request):
+        """
+        Handle a transaction sent by the homeserver.
+        :param request: The request containing the transaction.
+        :return: The response to send.
+        """
+        if self.lifecycle.draining:
+            # The homeserver retries the transaction once we're back up.
+            response = create_response(503, {'errcode':
+                                             'NL.SIJMENSCHOON.TELEMATRIX_SHUTTING_DOWN'})
+            response.headers['Retry-After'] = '5'
+            return response
+
+        body = await request.json()
+        events = []
+        stale = {}
+        for event in body['events']:
+            if self.backfill.is_stale(event):
+                # Replay these like missed events, so a long backlog is
+                # summarized instead of flooding Telegram.
+                stale.setdefault(event['room_id'], []).append(event)
+                continue
+            try:
+                print('{}: <{}> {}'.format(event['room_id'], event['user_id'], event['type']))
+            except KeyError:
+                pass
+
+            if event['type'] == 'm.room.aliases' and event['state_key'] == self.config.matrix_host_bare:
+                aliases = event['content']['aliases']
+
+                links = self.session.query(db.ChatLink)\
+                            .filter_by(matrix_room=event['room_id']).all()
+                options = {}
+                for link in links:
+                    options[str(link.tg_room)] = self.queue_options(link)
+                    self.session.delete(link)
+
+                for alias in aliases:
+                    print(alias)
+                    if alias.split('_')[0] != '#telegram' \
+                            or alias.split(':')[-1] != self.config.matrix_host_bare:
+                        continue
+
+                    tg_id = alias.split('_')[1].split(':')[0]
+                    link = db.ChatLink(event['room_id'], tg_id, True)
+                    for key, value in options.get(tg_id, {}).items():
+                        setattr(link, 'queue_' + key, value)
+                    self.session.add(link)
+                    self.session.commit()
+
+                continue
+
+            links = self.session.query(db.ChatLink)\
+                        .filter_by(matrix_room=event['room_id']).all()
+            if not links:
+                print('{} isn\'t linked!'.format(event['room_id']))
+                continue
+            events.append((event, links))
+
+        # Stale events are held until the backlog of their room is through.
+        # They can't be refused later, and events delivered twice are only
+        # replayed once.
+        for room_id, room_events in stale.items():
+            self.backfill.add_stale(room_id, room_events)
+
+        # Either queue the whole transaction or none of it, so a retried
+        # transaction doesn't bridge events twice. The queue settings of a
+        # room are taken from its first link.
+        counts = Counter(links[0].matrix_room for _, links in events)
+        rooms = {links[0].matrix_room: links[0] for _, links in events}
+        for room_id in rooms:
+            # Live events come after any held stale ones.
+            self.backfill.flush(room_id)
+        for link in rooms.values():
+            if not self.scheduler.can_accept(link.matrix_room,
+                                             counts[link.matrix_room],
+                                             **self.queue_options(link)):
+                print('Queue for {} is full, asking for a retry'
+                      .format(link.matrix_room))
+                response = create_response(503, {'errcode':
+                                                 'NL.SIJMENSCHOON.TELEMATRIX_OVERLOADED'})
+                response.headers['Retry-After'] = '5'
+                return response
+
+        for event, links in events:
+            coalesce_key = None
+            if event['type'] == 'm.room.member':
+                coalesce_key = ('m.room.member', event['state_key'])
+            tg_rooms = [link.tg_room for link in links]
+            self.scheduler.submit(links[0].matrix_room,
+                                  partial(self.handle_matrix_event, event,
+                                          tg_rooms),
+                                  coalesce_key, force=True,
+                                  **self.queue_options(links[0]))
+            self.backfill.mark_queued(event)
+
+        self.session.commit()
+        return create_response(200, {})
 
-            links = db.session.query(db.ChatLink)\
-                      .filter_by(matrix_room=event['room_id']).all()
-            for link in links:
-                db.session.delete(link)
+    async def handle_matrix_event(self, event, tg_rooms):
+        """
+        Bridge a single event from a linked Matrix room to Telegram.
+        :param event: The event to bridge.
+        :param tg_rooms: The Telegram chats the room is linked to.
+        """
+        # Events can arrive twice, e.g. from catch-up and a retried transaction.
+        if self.is_bridged(event):
+            return
 
-            for alias in aliases:
-                print(alias)
-                if alias.split('_')[0] != '#telegram' \
-                        or alias.split(':')[-1] != MATRIX_HOST_BARE:
-                    continue
+        send = None
+        upload_first = False
 
-                tg_id = alias.split('_')[1].split(':')[0]
-                link = db.ChatLink(event['room_id'], tg_id, True)
-                db.session.add(link)
-                db.session.commit()
+        if event['type'] == 'm.room.message':
+            user_id = event['user_id']
+            if matrix_is_telegram(user_id):
+                return
 
-            continue
 
-        link = db.session.query(db.ChatLink)\
-                 .filter_by(matrix_room=event['room_id']).first()
-        if not link:
-            print('{} isn\'t linked!'.format(event['room_id']))
-            continue
-        group = TG_BOT.group(link.tg_room)
+            sender = self.session.query(db.MatrixUser)\
+                         .filter_by(matrix_id=user_id).first()
 
-        try:
-            response = None
+            if not sender:
+                response = await self.matrix_get('client', 'profile/{}/displayname'
+                                                           .format(user_id), None)
+                try:
+                    displayname = response['displayname']
+                except KeyError:
+                    displayname = get_username(user_id)
+                sender = db.MatrixUser(user_id, displayname)
+                self.session.add(sender)
+            else:
+                displayname = sender.name or get_username(user_id)
+            content = event['content']
+
+            if 'msgtype' not in content:
+                return
+
+            # Render the message once, whatever the number of linked chats.
+            host_bare = self.config.matrix_host_bare
+            if content['msgtype'] == 'm.text':
+                msg, mode = format_matrix_msg('{}', content, host_bare)
+                text = "<b>{}:</b> {}".format(displayname, msg)
+                send = lambda group: group.send_text(text, parse_mode='HTML')
+            elif content['msgtype'] == 'm.notice':
+                msg, mode = format_matrix_msg('{}', content, host_bare)
+                text = "[{}] {}".format(displayname, msg)
+                send = lambda group: group.send_text(text, parse_mode=mode)
+            elif content['msgtype'] == 'm.emote':
+                msg, mode = format_matrix_msg('{}', content, host_bare)
+                text = "* {} {}".format(displayname, msg)
+                send = lambda group: group.send_text(text, parse_mode=mode)
+            elif content['msgtype'] == 'm.image':
+                caption = '{} sent an image'.format(displayname)
+                if self.shortener.enabled:
+                    caption += ': ' + await self.media_link(urlparse(content['url']))
+                # Download at most once, however many chats need the upload.
+                download = shared(self.loop, partial(self.download_matrix_file,
+                                                     urlparse(content['url'])))
+                send = lambda group: self.send_matrix_image(group, content,
+                                                            caption, download)
+                upload_first = True
+            else:
+                print('Unsupported message type {}'.format(content['msgtype']))
+                print(json.dumps(content, indent=4))
 
-            if event['type'] == 'm.room.message':
-                user_id = event['user_id']
-                if matrix_is_telegram(user_id):
-                    continue
+        elif event['type'] == 'm.room.member':
+            if self.is_own_event(event):
+                return
 
+            user_id = event['state_key']
+            content = event['content']
 
-                sender = db.session.query(db.MatrixUser)\
-                           .filter_by(matrix_id=user_id).first()
+            sender = self.session.query(db.MatrixUser)\
+                         .filter_by(matrix_id=user_id).first()
+            if sender:
+                displayname = sender.name
+            else:
+                displayname = get_username(user_id)
+
+            msg = None
+            if content['membership'] == 'join':
+                oldname = sender.name if sender else get_username(user_id)
+                try:
+                    displayname = content['displayname'] or get_username(user_id)
+                except KeyError:
+                    displayname = get_username(user_id)
 
                 if not sender:
-                    response = await matrix_get('client', 'profile/{}/displayname'
-                                                          .format(user_id), None)
-                    try:
-                        displayname = response['displayname']
-                    except KeyError:
-                        displayname = get_username(user_id)
                     sender = db.MatrixUser(user_id, displayname)
-                    db.session.add(sender)
-                else:
-                    displayname = sender.name or get_username(user_id)
-                content = event['content']
-
-                if 'msgtype' not in content:
-                    continue
-
-                if content['msgtype'] == 'm.text':
-                    msg, mode = format_matrix_msg('{}', content)
-                    response = await group.send_text("<b>{}:</b> {}".format(displayname, msg), parse_mode='HTML')
-                elif content['msgtype'] == 'm.notice':
-                    msg, mode = format_matrix_msg('{}', content)
-                    response = await group.send_text("[{}] {}".format(displayname, msg), parse_mode=mode)
-                elif content['msgtype'] == 'm.emote':
-                    msg, mode = format_matrix_msg('{}', content)
-                    response = await group.send_text("* {} {}".format(displayname, msg), parse_mode=mode)
-                elif content['msgtype'] == 'm.image':
-                    try:
-                        url = urlparse(content['url'])
-
-                        # Append the correct extension if it's missing or wrong
-                        ext = mime_extensions[content['info']['mimetype']]
-                        if not content['body'].endswith(ext):
-                            content['body'] += '.' + ext
-
-                        # Download the file
-                        await download_matrix_file(url, content['body'])
-                        with open('/tmp/{}'.format(content['body']), 'rb') as img_file:
-                            # Create the URL and shorten it
-                            url_str = MATRIX_HOST_EXT + \
-                                      '_matrix/media/r0/download/{}{}' \
-                                      .format(url.netloc, quote(url.path))
-                            url_str = await shorten_url(url_str)
-
-                            caption = '{} sent an image'.format(displayname)
-                            response = await group.send_photo(img_file, caption=caption)
-                    except:
-                        pass
                 else:
-                    print('Unsupported message type {}'.format(content['msgtype']))
-                    print(json.dumps(content, indent=4))
+                    sender.name = displayname
+                self.session.add(sender)
 
-            elif event['type'] == 'm.room.member':
-                if matrix_is_telegram(event['state_key']):
-                    continue
+                if 'unsigned' in event and 'prev_content' in event['unsigned']:
+                    prev = event['unsigned']['prev_content']
+                    if prev['membership'] == 'join':
+                        if 'displayname' in prev and prev['displayname']:
+                            oldname = prev['displayname']
 
-                user_id = event['state_key']
-                content = event['content']
-
-                sender = db.session.query(db.MatrixUser)\
-                           .filter_by(matrix_id=user_id).first()
-                if sender:
-                    displayname = sender.name
+                        msg = '> {} changed their display name to {}'\
+                              .format(oldname, displayname)
                 else:
-                    displayname = get_username(user_id)
-
-                if content['membership'] == 'join':
-                    oldname = sender.name if sender else get_username(user_id)
-                    try:
-                        displayname = content['displayname'] or get_username(user_id)
-                    except KeyError:
-                        displayname = get_username(user_id)
-
-                    if not sender:
-                        sender = db.MatrixUser(user_id, displayname)
-                    else:
-                        sender.name = displayname
-                    db.session.add(sender)
-
-                    msg = None
-                    if 'unsigned' in event and 'prev_content' in event['unsigned']:
-                        prev = event['unsigned']['prev_content']
-                        if prev['membership'] == 'join':
-                            if 'displayname' in prev and prev['displayname']:
-                                oldname = prev['displayname']
-
-                            msg = '> {} changed their display name to {}'\
-                                  .format(oldname, displayname)
-                    else:
-                        msg = '> {} has joined the room'.format(displayname)
-
-                    if msg:
-                        response = await group.send_text(msg)
-                elif content['membership'] == 'leave':
-                    msg = '< {} has left the room'.format(displayname)
-                    response = await group.send_text(msg)
-                elif content['membership'] == 'ban':
-                    msg = '<! {} was banned from the room'.format(displayname)
-                    response = await group.send_text(msg)
-
+                    msg = '> {} has joined the room'.format(displayname)
+            elif content['membership'] == 'leave':
+                msg = '< {} has left the room'.format(displayname)
+            elif content['membership'] == 'ban':
+                msg = '<! {} was banned from the room'.format(displayname)
+
+            if msg:
+                send = lambda group: group.send_text(msg)
+
+        if send:
+            await self.send_to_groups(event, tg_rooms, send, displayname,
+                                      upload_first)
+        self.session.commit()
+
+    async def send_to_groups(self, event, tg_rooms, send, displayname,
+                             upload_first=False):
+        """
+        Send a message to several Telegram chats concurrently and remember
+        the sent messages. A failure in one chat doesn't affect the others.
+        :param event: The Matrix event the message is bridged from.
+        :param tg_rooms: The Telegram chats to send to.
+        :param send: A coroutine function sending the message to a chat.
+        :param displayname: The display name of the sender.
+        :param upload_first: Whether to send to the first chat on its own,
+                             so the others can reuse what it uploaded.
+        """
+        # pylint: disable=too-many-arguments
+        async def send_to(group):
+            try:
+                return await send(group)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:  # pylint: disable=broad-except
+                print('Could not send to Telegram chat {}: {}'
+                      .format(group.id, e))
+
+        groups = [self.bot.group(tg_room) for tg_room in tg_rooms]
+        first = 1 if upload_first else 0
+        responses = [await send_to(group) for group in groups[:first]]
+        responses += await asyncio.gather(*[send_to(group) for group in groups[first:]],
+                                          loop=self.loop)
+
+        for response in responses:
             if response:
                 message = db.Message(
                     response['result']['chat']['id'],
@@ -319,381 +573,431 @@ async def matrix_transaction(request):
                     event['room_id'],
                     event['event_id'],
                     displayname)
-                db.session.add(message)
-
-        except RuntimeError as e:
-            print('Got a runtime error:', e)
-            print('Group:', group)
-
-    db.session.commit()
-    return create_response(200, {})
-
-
-async def _matrix_request(method_fun, category, path, user_id, data=None,
-                          content_type=None):
-    # pylint: disable=too-many-arguments
-    # Due to this being a helper function, the argument count acceptable
-    if content_type is None:
-        content_type = 'application/octet-stream'
-    if data is not None:
-        if isinstance(data, dict):
-            data = json.dumps(data)
-            content_type = 'application/json; charset=utf-8'
-
-    params = {'access_token': AS_TOKEN}
-    if user_id is not None:
-        params['user_id'] = user_id
-
-    async with method_fun('{}_matrix/{}/r0/{}'
-                          .format(MATRIX_HOST, quote(category), quote(path)),
-                          params=params, data=data,
-                          headers={'Content-Type': content_type}) as response:
-        if response.headers['Content-Type'].split(';')[0] \
-                == 'application/json':
-            return await response.json()
-        else:
-            return await response.read()
+                self.session.add(message)
+
+    async def _matrix_request(self, method_fun, category, path, user_id,
+                              data=None, content_type=None, params=None):
+        # pylint: disable=too-many-arguments
+        # Due to this being a helper function, the argument count acceptable
+        if content_type is None:
+            content_type = 'application/octet-stream'
+        if data is not None:
+            if isinstance(data, dict):
+                data = json.dumps(data)
+                content_type = 'application/json; charset=utf-8'
+
+        params = dict(params or {}, access_token=self.config.as_token)
+        if user_id is not None:
+            params['user_id'] = user_id
+
+        async with method_fun('{}_matrix/{}/r0/{}'
+                              .format(self.config.matrix_host, quote(category),
+                                      quote(path)),
+                              params=params, data=data,
+                              headers={'Content-Type': content_type}) as response:
+            if response.headers['Content-Type'].split(';')[0] \
+                    == 'application/json':
+                return await response.json()
+            else:
+                return await response.read()
+
+    def matrix_post(self, category, path, user_id, data, content_type=None):
+        return self._matrix_request(self.matrix_sess.post, category, path,
+                                    user_id, data, content_type)
 
+    def matrix_put(self, category, path, user_id, data, content_type=None):
+        return self._matrix_request(self.matrix_sess.put, category, path,
+                                    user_id, data, content_type)
 
-def matrix_post(category, path, user_id, data, content_type=None):
-    return _matrix_request(MATRIX_SESS.post, category, path, user_id, data,
-                           content_type)
+    def matrix_get(self, category, path, user_id, params=None):
+        return self._matrix_request(self.matrix_sess.get, category, path,
+                                    user_id, params=params)
 
+    def matrix_delete(self, category, path, user_id):
+        return self._matrix_request(self.matrix_sess.delete, category, path,
+                                    user_id)
 
-def matrix_put(category, path, user_id, data, content_type=None):
-    return _matrix_request(MATRIX_SESS.put, category, path, user_id, data,
-                           content_type)
+    async def matrix_room(self, request):
+        room_alias = request.match_info['room_alias']
+        args = parse_qs(urlparse(request.path_qs).query)
+        print('Checking for {} | {}'.format(unquote(room_alias),
+                                            args['access_token'][0]))
 
+        try:
+            if args['access_token'][0] != self.config.hs_token:
+                return create_response(403, {'errcode': 'M_FORBIDDEN'})
+        except KeyError:
+            return create_response(401,
+                                   {'errcode':
+                                    'NL.SIJMENSCHOON.TELEMATRIX_UNAUTHORIZED'})
+
+        localpart = room_alias.split(':')[0]
+        chat = '_'.join(localpart.split('_')[1:])
+
+        # Look up the chat in the database
+        link = self.session.query(db.ChatLink).filter_by(tg_room=chat).first()
+        if link:
+            await self.matrix_post('client', 'createRoom', None,
+                                   {'room_alias_name': localpart[1:]})
+            return create_response(200, {})
+        else:
+            return create_response(404, {'errcode':
+                                         'NL.SIJMENSCHOON.TELEMATRIX_NOT_FOUND'})
+
+    async def bridge_stats(self, request):
+        """
+        Report the state of the room queues, for monitoring.
+        :param request: The request, authenticated with the HS token.
+        :return: The response to send.
+        """
+        args = parse_qs(urlparse(request.path_qs).query)
+        try:
+            if args['access_token'][0] != self.config.hs_token:
+                return create_response(403, {'errcode': 'M_FORBIDDEN'})
+        except KeyError:
+            return create_response(401,
+                                   {'errcode':
+                                    'NL.SIJMENSCHOON.TELEMATRIX_UNAUTHORIZED'})
+
+        return create_response(200, {'in_flight': self.lifecycle.in_flight,
+                                     'draining': self.lifecycle.draining,
+                                     'rooms': self.scheduler.stats()})
+
+    def send_matrix_message(self, room_id, user_id, txn_id, **kwargs):
+        url = 'rooms/{}/send/m.room.message/{}'.format(room_id, txn_id)
+        return self.matrix_put('client', url, user_id, kwargs)
+
+    async def upload_tgfile_to_matrix(self, file_id, user_id, mime='image/jpeg', convert_to=None):
+        # Converted files don't have the content of the Telegram file, so only
+        # reuse and remember uploads of unconverted ones.
+        if not convert_to:
+            uri, length = self.media.mxc_url(file_id)
+            if uri:
+                return uri, length
+
+        file_path = (await self.bot.get_file(file_id))['file_path']
+        request = await self.bot.download_file(file_path)
+        data = await request.read()
+
+        if convert_to:
+            # Pillow is only needed to convert stickers, so import it lazily.
+            from PIL import Image
+
+            image = Image.open(BytesIO(data))
+            png_image = BytesIO(None)
+            image.save(png_image, convert_to)
+
+            j = await self.matrix_post('media', 'upload', user_id, png_image.getvalue(), mime)
+            length = len(png_image.getvalue())
+        else:
+            j = await self.matrix_post('media', 'upload', user_id, data, mime)
+            length = len(data)
 
-def matrix_get(category, path, user_id):
-    return _matrix_request(MATRIX_SESS.get, category, path, user_id)
+        if 'content_uri' in j:
+            if not convert_to:
+                self.media.add(j['content_uri'], file_id, length)
+            return j['content_uri'], length
+        else:
+            return None, 0
 
+    async def register_join_matrix(self, chat, room_id, user_id):
+        name = tg_displayname(chat.sender)
+        user = user_id.split(':')[0][1:]
 
-def matrix_delete(category, path, user_id):
-    return _matrix_request(MATRIX_SESS.delete, category, path, user_id)
+        await self.matrix_post('client', 'register', None,
+                               {'type': 'm.login.application_service', 'user': user})
+        profile_photos = await self.bot.get_user_profile_photos(chat.sender['id'])
+        try:
+            pp_file_id = profile_photos['result']['photos'][0][-1]['file_id']
+            pp_uri, _ = await self.upload_tgfile_to_matrix(pp_file_id, user_id)
+            if pp_uri:
+                await self.matrix_put('client', 'profile/{}/avatar_url'.format(user_id),
+                                      user_id, {'avatar_url': pp_uri})
+        except IndexError:
+            pass
 
+        await self.matrix_put('client', 'profile/{}/displayname'.format(user_id),
+                              user_id, {'displayname': name})
+        await self.matrix_post('client', 'join/{}'.format(room_id), user_id, {})
 
-async def matrix_room(request):
-    room_alias = request.match_info['room_alias']
-    args = parse_qs(urlparse(request.path_qs).query)
-    print('Checking for {} | {}'.format(unquote(room_alias),
-                                        args['access_token'][0]))
+    async def update_matrix_displayname_avatar(self, tg_user):
+        name = tg_displayname(tg_user)
+        user_id = self.config.user_id_format.format(tg_user['id'])
 
-    try:
-        if args['access_token'][0] != HS_TOKEN:
-            return create_response(403, {'errcode': 'M_FORBIDDEN'})
-    except KeyError:
-        return create_response(401,
-                               {'errcode':
-                                'NL.SIJMENSCHOON.TELEMATRIX_UNAUTHORIZED'})
-
-    localpart = room_alias.split(':')[0]
-    chat = '_'.join(localpart.split('_')[1:])
-
-    # Look up the chat in the database
-    link = db.session.query(db.ChatLink).filter_by(tg_room=chat).first()
-    if link:
-        await matrix_post('client', 'createRoom', None,
-                          {'room_alias_name': localpart[1:]})
-        return create_response(200, {})
-    else:
-        return create_response(404, {'errcode':
-                                     'NL.SIJMENSCHOON.TELEMATRIX_NOT_FOUND'})
+        db_user = self.session.query(db.TgUser).filter_by(tg_id=tg_user['id']).first()
 
+        profile_photos = await self.bot.get_user_profile_photos(tg_user['id'])
+        pp_file_id = None
+        try:
+            pp_file_id = profile_photos['result']['photos'][0][-1]['file_id']
+        except:
+            pp_file_id = None
+
+        if db_user:
+            if db_user.name != name:
+                await self.matrix_put('client', 'profile/{}/displayname'.format(user_id), user_id, {'displayname': name})
+                db_user.name = name
+            if db_user.profile_pic_id != pp_file_id:
+                if pp_file_id:
+                    pp_uri, _ = await self.upload_tgfile_to_matrix(pp_file_id, user_id)
+                    await self.matrix_put('client', 'profile/{}/avatar_url'.format(user_id), user_id, {'avatar_url':pp_uri})
+                else:
+                    await self.matrix_put('client', 'profile/{}/avatar_url'.format(user_id), user_id, {'avatar_url':None})
+                db_user.profile_pic_id = pp_file_id
+        else:
+            db_user = db.TgUser(tg_user['id'], name, pp_file_id)
+            await self.matrix_put('client', 'profile/{}/displayname'.format(user_id), user_id, {'displayname': name})
+            if pp_file_id:
+                pp_uri, _ = await self.upload_tgfile_to_matrix(pp_file_id, user_id)
+                await self.matrix_put('client', 'profile/{}/avatar_url'.format(user_id), user_id, {'avatar_url':pp_uri})
+            else:
+                await self.matrix_put('client', 'profile/{}/avatar_url'.format(user_id), user_id, {'avatar_url':None})
+            self.session.add(db_user)
+        self.session.commit()
+
+    async def send_to_rooms(self, chat, links, user_id, txn_id, content):
+        """
+        Send a message from Telegram to several Matrix rooms concurrently and
+        remember the sent events. A failure in one room doesn't affect the
+        others.
+        :param chat: The Telegram chat the message was sent in.
+        :param links: The ChatLinks of the rooms to send to.
+        :param user_id: The Matrix user to send as.
+        :param txn_id: The transaction ID of the message.
+        :param content: The content of the message, or a function returning
+                        it for a room ID if it differs per room.
+        """
+        # pylint: disable=too-many-arguments
+        async def send_to(room_id):
+            room_content = content(room_id) if callable(content) else content
+            try:
+                j = await self.send_matrix_message(room_id, user_id, txn_id,
+                                                   **room_content)
+
+                if 'errcode' in j and j['errcode'] == 'M_FORBIDDEN':
+                    await self.register_join_matrix(chat, room_id, user_id)
+                    await asyncio.sleep(0.5)
+                    j = await self.send_matrix_message(room_id, user_id,
+                                                       txn_id + 'join',
+                                                       **room_content)
+
+                if 'caption' in chat.message:
+                    await self.send_matrix_message(room_id, user_id, txn_id + 'caption',
+                                                   body=chat.message['caption'],
+                                                   msgtype='m.text')
+                return j
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:  # pylint: disable=broad-except
+                print('Could not send to Matrix room {}: {}'.format(room_id, e))
+                return {}
+
+        room_ids = [link.matrix_room for link in links]
+        results = await asyncio.gather(*[send_to(room_id) for room_id in room_ids],
+                                       loop=self.loop)
+
+        name = tg_displayname(chat.sender)
+        events = {}
+        for room_id, j in zip(room_ids, results):
+            if 'event_id' in j:
+                events[room_id] = j['event_id']
+                message = db.Message(
+                        chat.message['chat']['id'],
+                        chat.message['message_id'],
+                        room_id,
+                        j['event_id'],
+                        name)
+                self.session.add(message)
+        self.session.commit()
+
+        await self.relay_to_chats(chat, events)
+
+    async def relay_to_chats(self, chat, events):
+        """
+        Forward a Telegram message to the other Telegram chats linked to the
+        same Matrix rooms. They don't get it through Matrix, because the
+        bridge ignores the events of its own Telegram users.
+        :param chat: The Telegram chat the message was sent in.
+        :param events: A dict from Matrix room ID to the event the message
+                       was bridged as.
+        """
+        if not events:
+            return
 
-def send_matrix_message(room_id, user_id, txn_id, **kwargs):
-    url = 'rooms/{}/send/m.room.message/{}'.format(room_id, txn_id)
-    return matrix_put('client', url, user_id, kwargs)
+        links = self.session.query(db.ChatLink)\
+                    .filter(db.ChatLink.matrix_room.in_(list(events)),
+                            db.ChatLink.tg_room != chat.id).all()
+        targets = {}
+        for link in links:
+            targets.setdefault(link.tg_room, []).append(link.matrix_room)
+
+        async def forward(tg_room):
+            try:
+                return await self.bot.group(tg_room).forward_message(
+                    chat.id, chat.message['message_id'])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:  # pylint: disable=broad-except
+                print('Could not relay to Telegram chat {}: {}'.format(tg_room, e))
+
+        tg_rooms = list(targets)
+        responses = await asyncio.gather(*[forward(tg_room) for tg_room in tg_rooms],
+                                         loop=self.loop)
+
+        # Remember the copies too, so replies to them link to the event.
+        name = tg_displayname(chat.sender)
+        for tg_room, response in zip(tg_rooms, responses):
+            if not response:
+                continue
+            for room_id in targets[tg_room]:
+                message = db.Message(
+                        response['result']['chat']['id'],
+                        response['result']['message_id'],
+                        room_id,
+                        events[room_id],
+                        name)
+                self.session.add(message)
+        self.session.commit()
+
+    async def aiotg_sticker(self, chat, sticker):
+        links = self.session.query(db.ChatLink).filter_by(tg_room=chat.id).all()
+        if not links:
+            print('Unknown telegram chat {}: {}'.format(chat, chat.id))
+            return
 
+        await self.update_matrix_displayname_avatar(chat.sender);
 
-async def upload_tgfile_to_matrix(file_id, user_id, mime='image/jpeg', convert_to=None):
-    file_path = (await TG_BOT.get_file(file_id))['file_path']
-    request = await TG_BOT.download_file(file_path)
-    data = await request.read()
+        user_id = self.config.user_id_format.format(chat.sender['id'])
+        txn_id = quote('{}{}'.format(chat.message['message_id'], chat.id))
 
-    if convert_to:
-        image = Image.open(BytesIO(data))
-        png_image = BytesIO(None)
-        image.save(png_image, convert_to)
+        # Upload once, and link the same file in every room.
+        file_id = sticker['file_id']
+        uri, length = await self.upload_tgfile_to_matrix(file_id, user_id, 'image/png', 'PNG')
 
-        j = await matrix_post('media', 'upload', user_id, png_image.getvalue(), mime)
-        length = len(png_image.getvalue())
-    else:
-        j = await matrix_post('media', 'upload', user_id, data, mime)
-        length = len(data)
+        info = {'mimetype': 'image/png', 'size': length, 'h': sticker['height'],
+                'w': sticker['width']}
+        body = 'Sticker_{}.png'.format(int(time() * 1000))
 
-    if 'content_uri' in j:
-        return j['content_uri'], length
-    else:
-        return None, 0
+        if uri:
+            await self.send_to_rooms(chat, links, user_id, txn_id,
+                                     {'body': body, 'url': uri, 'info': info,
+                                      'msgtype': 'm.image'})
 
+    async def aiotg_photo(self, chat, photo):
+        links = self.session.query(db.ChatLink).filter_by(tg_room=chat.id).all()
+        if not links:
+            print('Unknown telegram chat {}: {}'.format(chat, chat.id))
+            return
 
-async def register_join_matrix(chat, room_id, user_id):
-    name = chat.sender['first_name']
-    if 'last_name' in chat.sender:
-        name += ' ' + chat.sender['last_name']
-    name += ' (Telegram)'
-    user = user_id.split(':')[0][1:]
+        await self.update_matrix_displayname_avatar(chat.sender);
+        user_id = self.config.user_id_format.format(chat.sender['id'])
+        txn_id = quote('{}{}'.format(chat.message['message_id'], chat.id))
+
+        # Upload once, and link the same file in every room.
+        file_id = photo[-1]['file_id']
+        uri, length = await self.upload_tgfile_to_matrix(file_id, user_id)
+        info = {'mimetype': 'image/jpeg', 'size': length, 'h': photo[-1]['height'],
+                'w': photo[-1]['width']}
+        body = 'Image_{}.jpg'.format(int(time() * 1000))
+
+        if uri:
+            await self.send_to_rooms(chat, links, user_id, txn_id,
+                                     {'body': body, 'url': uri, 'info': info,
+                                      'msgtype': 'm.image'})
+
+    async def aiotg_alias(self, chat, match):
+        await chat.reply('The Matrix alias for this chat is #telegram_{}:{}'
+                         .format(chat.id, self.config.matrix_host_bare))
+
+    async def aiotg_message(self, chat, match):
+        links = self.session.query(db.ChatLink).filter_by(tg_room=chat.id).all()
+        if not links:
+            print('Unknown telegram chat {}: {}'.format(chat, chat.id))
+            return
 
-    await matrix_post('client', 'register', None,
-                      {'type': 'm.login.application_service', 'user': user})
-    profile_photos = await TG_BOT.get_user_profile_photos(chat.sender['id'])
-    try:
-        pp_file_id = profile_photos['result']['photos'][0][-1]['file_id']
-        pp_uri, _ = await upload_tgfile_to_matrix(pp_file_id, user_id)
-        if pp_uri:
-            await matrix_put('client', 'profile/{}/avatar_url'.format(user_id),
-                             user_id, {'avatar_url': pp_uri})
-    except IndexError:
-        pass
-
-    await matrix_put('client', 'profile/{}/displayname'.format(user_id),
-                     user_id, {'displayname': name})
-    await matrix_post('client', 'join/{}'.format(room_id), user_id, {})
-
-async def update_matrix_displayname_avatar(tg_user):
-    name = tg_user['first_name']
-    if 'last_name' in tg_user:
-        name += ' ' + tg_user['last_name']
-    name += ' (Telegram)'
-    user_id = USER_ID_FORMAT.format(tg_user['id'])
-    
-    db_user = db.session.query(db.TgUser).filter_by(tg_id=tg_user['id']).first()
+        await self.update_matrix_displayname_avatar(chat.sender);
+        user_id = self.config.user_id_format.format(chat.sender['id'])
+        txn_id = quote('{}:{}'.format(chat.message['message_id'], chat.id))
 
-    profile_photos = await TG_BOT.get_user_profile_photos(tg_user['id'])
-    pp_file_id = None
-    try:
-        pp_file_id = profile_photos['result']['photos'][0][-1]['file_id']
-    except:
-        pp_file_id = None
+        message = match.group(0)
 
-    if db_user:
-        if db_user.name != name:
-            await matrix_put('client', 'profile/{}/displayname'.format(user_id), user_id, {'displayname': name})
-            db_user.name = name
-        if db_user.profile_pic_id != pp_file_id:
-            if pp_file_id:
-                pp_uri, _ = await upload_tgfile_to_matrix(pp_file_id, user_id)
-                await matrix_put('client', 'profile/{}/avatar_url'.format(user_id), user_id, {'avatar_url':pp_uri})
+        if 'forward_from' in chat.message:
+            fw_from = chat.message['forward_from']
+            if 'last_name' in fw_from:
+                msg_from = '{} {} (Telegram)'.format(fw_from['first_name'],
+                                                     fw_from['last_name'])
             else:
-                await matrix_put('client', 'profile/{}/avatar_url'.format(user_id), user_id, {'avatar_url':None})
-            db_user.profile_pic_id = pp_file_id
-    else:
-        db_user = db.TgUser(tg_user['id'], name, pp_file_id)
-        await matrix_put('client', 'profile/{}/displayname'.format(user_id), user_id, {'displayname': name})
-        if pp_file_id:
-            pp_uri, _ = await upload_tgfile_to_matrix(pp_file_id, user_id)
-            await matrix_put('client', 'profile/{}/avatar_url'.format(user_id), user_id, {'avatar_url':pp_uri})
-        else:
-            await matrix_put('client', 'profile/{}/avatar_url'.format(user_id), user_id, {'avatar_url':None})
-        db.session.add(db_user)
-    db.session.commit()
-        
-
-@TG_BOT.handle('sticker')
-async def aiotg_sticker(chat, sticker):
-    link = db.session.query(db.ChatLink).filter_by(tg_room=chat.id).first()
-    if not link:
-        print('Unknown telegram chat {}: {}'.format(chat, chat.id))
-        return
-
-    await update_matrix_displayname_avatar(chat.sender);
-
-    room_id = link.matrix_room
-    user_id = USER_ID_FORMAT.format(chat.sender['id'])
-    txn_id = quote('{}{}'.format(chat.message['message_id'], chat.id))
-
-    file_id = sticker['file_id']
-    uri, length = await upload_tgfile_to_matrix(file_id, user_id, 'image/png', 'PNG')
-
-    info = {'mimetype': 'image/png', 'size': length, 'h': sticker['height'],
-            'w': sticker['width']}
-    body = 'Sticker_{}.png'.format(int(time() * 1000))
-
-    if uri:
-        j = await send_matrix_message(room_id, user_id, txn_id, body=body,
-                                      url=uri, info=info, msgtype='m.image')
-
-        if 'errcode' in j and j['errcode'] == 'M_FORBIDDEN':
-            await register_join_matrix(chat, room_id, user_id)
-            await send_matrix_message(room_id, user_id, txn_id + 'join',
-                                      body=body, url=uri, info=info,
-                                      msgtype='m.image')
-
-        if 'caption' in chat.message:
-            await send_matrix_message(room_id, user_id, txn_id + 'caption',
-                                      body=chat.message['caption'],
-                                      msgtype='m.text')
-        if 'event_id' in j:
-            name = chat.sender['first_name']
-            if 'last_name' in chat.sender:
-                name += " " + chat.sender['last_name']
-            name += " (Telegram)"
-            message = db.Message(
-                    chat.message['chat']['id'],
-                    chat.message['message_id'],
-                    room_id,
-                    j['event_id'],
-                    name)
-            db.session.add(message)
-            db.session.commit()
-
-@TG_BOT.handle('photo')
-async def aiotg_photo(chat, photo):
-    link = db.session.query(db.ChatLink).filter_by(tg_room=chat.id).first()
-    if not link:
-        print('Unknown telegram chat {}: {}'.format(chat, chat.id))
-        return
-
-    await update_matrix_displayname_avatar(chat.sender);
-    room_id = link.matrix_room
-    user_id = USER_ID_FORMAT.format(chat.sender['id'])
-    txn_id = quote('{}{}'.format(chat.message['message_id'], chat.id))
-
-    file_id = photo[-1]['file_id']
-    uri, length = await upload_tgfile_to_matrix(file_id, user_id)
-    info = {'mimetype': 'image/jpeg', 'size': length, 'h': photo[-1]['height'],
-            'w': photo[-1]['width']}
-    body = 'Image_{}.jpg'.format(int(time() * 1000))
-
-    if uri:
-        j = await send_matrix_message(room_id, user_id, txn_id, body=body,
-                                      url=uri, info=info, msgtype='m.image')
-
-        if 'errcode' in j and j['errcode'] == 'M_FORBIDDEN':
-            await register_join_matrix(chat, room_id, user_id)
-            await send_matrix_message(room_id, user_id, txn_id + 'join',
-                                      body=body, url=uri, info=info,
-                                      msgtype='m.image')
-
-        if 'caption' in chat.message:
-            await send_matrix_message(room_id, user_id, txn_id + 'caption',
-                                      body=chat.message['caption'],
-                                      msgtype='m.text')
-
-        if 'event_id' in j:
-            name = chat.sender['first_name']
-            if 'last_name' in chat.sender:
-                name += " " + chat.sender['last_name']
-            name += " (Telegram)"
-            message = db.Message(
-                    chat.message['chat']['id'],
-                    chat.message['message_id'],
-                    room_id,
-                    j['event_id'],
-                    name)
-            db.session.add(message)
-            db.session.commit()
-
-@TG_BOT.command(r'/alias')
-async def aiotg_alias(chat, match):
-    await chat.reply('The Matrix alias for this chat is #telegram_{}:{}'
-                     .format(chat.id, MATRIX_HOST_BARE))
-
-
-@TG_BOT.command(r'(?s)(.*)')
-async def aiotg_message(chat, match):
-    link = db.session.query(db.ChatLink).filter_by(tg_room=chat.id).first()
-    if link:
-        room_id = link.matrix_room
-    else:
-        print('Unknown telegram chat {}: {}'.format(chat, chat.id))
-        return
+                msg_from = '{} (Telegram)'.format(fw_from['first_name'])
 
-    await update_matrix_displayname_avatar(chat.sender);
-    user_id = USER_ID_FORMAT.format(chat.sender['id'])
-    txn_id = quote('{}:{}'.format(chat.message['message_id'], chat.id))
+            quoted_msg = '\n'.join(['>{}'.format(x) for x in message.split('\n')])
+            quoted_msg = 'Forwarded from {}:\n{}' \
+                         .format(msg_from, quoted_msg)
 
-    message = match.group(0)
-
-    if 'forward_from' in chat.message:
-        fw_from = chat.message['forward_from']
-        if 'last_name' in fw_from:
-            msg_from = '{} {} (Telegram)'.format(fw_from['first_name'],
-                                                 fw_from['last_name'])
-        else:
-            msg_from = '{} (Telegram)'.format(fw_from['first_name'])
-
-        quoted_msg = '\n'.join(['>{}'.format(x) for x in message.split('\n')])
-        quoted_msg = 'Forwarded from {}:\n{}' \
-                     .format(msg_from, quoted_msg)
-
-        quoted_html = '<blockquote>{}</blockquote>' \
-                      .format(html.escape(message).replace('\n', '<br />'))
-        quoted_html = '<i>Forwarded from {}:</i>\n{}' \
-                      .format(html.escape(msg_from), quoted_html)
-        j = await send_matrix_message(room_id, user_id, txn_id,
-                                      body=quoted_msg,
-                                      formatted_body=quoted_html,
-                                      format='org.matrix.custom.html',
-                                      msgtype='m.text')
-
-    elif 'reply_to_message' in chat.message:
-        re_msg = chat.message['reply_to_message']
-        if not 'text' in re_msg and not 'photo' in re_msg and not 'sticker' in re_msg:
-            return
-        if 'last_name' in re_msg['from']:
-            msg_from = '{} {} (Telegram)'.format(re_msg['from']['first_name'],
-                                                 re_msg['from']['last_name'])
+            quoted_html = '<blockquote>{}</blockquote>' \
+                          .format(html.escape(message).replace('\n', '<br />'))
+            quoted_html = '<i>Forwarded from {}:</i>\n{}' \
+                          .format(html.escape(msg_from), quoted_html)
+            content = {'body': quoted_msg, 'formatted_body': quoted_html,
+                       'format': 'org.matrix.custom.html', 'msgtype': 'm.text'}
+
+        elif 'reply_to_message' in chat.message:
+            re_msg = chat.message['reply_to_message']
+            if not 'text' in re_msg and not 'photo' in re_msg and not 'sticker' in re_msg:
+                return
+            if 'last_name' in re_msg['from']:
+                msg_from = '{} {} (Telegram)'.format(re_msg['from']['first_name'],
+                                                     re_msg['from']['last_name'])
+            else:
+                msg_from = '{} (Telegram)'.format(re_msg['from']['first_name'])
+            date = datetime.fromtimestamp(re_msg['date']) \
+                   .strftime('%Y-%m-%d %H:%M:%S')
+
+            html_message = html.escape(message).replace('\n', '<br />')
+            if 'text' in re_msg:
+                quoted_msg = '\n'.join(['>{}'.format(x)
+                                        for x in re_msg['text'].split('\n')])
+                quoted_html = '<blockquote>{}</blockquote>' \
+                              .format(html.escape(re_msg['text'])
+                                      .replace('\n', '<br />'))
+            else:
+                quoted_msg = ''
+                quoted_html = ''
+
+            # The replied-to event differs per room, so only the link to it
+            # is rendered per room.
+            def content(room_id):
+                reply_mx_id = self.session.query(db.Message)\
+                        .filter_by(tg_group_id=chat.message['chat']['id'], tg_message_id=re_msg['message_id'],
+                                   matrix_room_id=room_id).first()
+
+                if reply_mx_id:
+                    reply_msg = 'Reply to {}:\n{}\n\n{}' \
+                                .format(reply_mx_id.displayname, quoted_msg, message)
+                    reply_html = '<i><a href="https://matrix.to/#/{}/{}">Reply to {}</a>:</i><br />{}<p>{}</p>' \
+                                 .format(html.escape(room_id), html.escape(reply_mx_id.matrix_event_id), html.escape(reply_mx_id.displayname),
+                                         quoted_html, html_message)
+                else:
+                    reply_msg = 'Reply to {}:\n{}\n\n{}' \
+                                .format(msg_from, quoted_msg, message)
+                    reply_html = '<i>Reply to {}:</i><br />{}<p>{}</p>' \
+                                 .format(html.escape(msg_from),
+                                         quoted_html, html_message)
+                return {'body': reply_msg, 'formatted_body': reply_html,
+                        'format': 'org.matrix.custom.html', 'msgtype': 'm.text'}
         else:
-            msg_from = '{} (Telegram)'.format(re_msg['from']['first_name'])
-        date = datetime.fromtimestamp(re_msg['date']) \
-               .strftime('%Y-%m-%d %H:%M:%S')
+            content = {'body': message, 'msgtype': 'm.text'}
 
-        reply_mx_id = db.session.query(db.Message)\
-                .filter_by(tg_group_id=chat.message['chat']['id'], tg_message_id=chat.message['reply_to_message']['message_id']).first()
+        await self.send_to_rooms(chat, links, user_id, txn_id, content)
 
-        html_message = html.escape(message).replace('\n', '<br />')
-        if 'text' in re_msg:
-            quoted_msg = '\n'.join(['>{}'.format(x)
-                                    for x in re_msg['text'].split('\n')])
-            quoted_html = '<blockquote>{}</blockquote>' \
-                          .format(html.escape(re_msg['text'])
-                                  .replace('\n', '<br />'))
-        else:
-            quoted_msg = ''
-            quoted_html = ''
-
-        if reply_mx_id:
-            quoted_msg = 'Reply to {}:\n{}\n\n{}' \
-                         .format(reply_mx_id.displayname, quoted_msg, message)
-            quoted_html = '<i><a href="https://matrix.to/#/{}/{}">Reply to {}</a>:</i><br />{}<p>{}</p>' \
-                          .format(html.escape(room_id), html.escape(reply_mx_id.matrix_event_id), html.escape(reply_mx_id.displayname),
-                                  quoted_html, html_message)
-        else:
-            quoted_msg = 'Reply to {}:\n{}\n\n{}' \
-                         .format(msg_from, quoted_msg, message)
-            quoted_html = '<i>Reply to {}:</i><br />{}<p>{}</p>' \
-                          .format(html.escape(msg_from),
-                                  quoted_html, html_message)
-
-        j = await send_matrix_message(room_id, user_id, txn_id,
-                                      body=quoted_msg,
-                                      formatted_body=quoted_html,
-                                      format='org.matrix.custom.html',
-                                      msgtype='m.text')
-    else:
-        j = await send_matrix_message(room_id, user_id, txn_id, body=message,
-                                      msgtype='m.text')
-
-    if 'errcode' in j and j['errcode'] == 'M_FORBIDDEN':
-        await register_join_matrix(chat, room_id, user_id)
-        await asyncio.sleep(0.5)
-        j = await send_matrix_message(room_id, user_id, txn_id + 'join',
-                                      body=message, msgtype='m.text')
-    elif 'event_id' in j:
-        name = chat.sender['first_name']
-        if 'last_name' in chat.sender:
-            name += " " + chat.sender['last_name']
-        name += " (Telegram)"
-        message = db.Message(
-                chat.message['chat']['id'],
-                chat.message['message_id'],
-                room_id,
-                j['event_id'],
-                name)
-        db.session.add(message)
-        db.session.commit()
+
+def create_bridge(config_path='config.json', loop=None):
+    """
+    Read the configuration and build a bridge from it.
+    :param config_path: The path of the configuration file.
+    :param loop: The event loop to run the bridge on.
+    :return: A Bridge.
+    """
+    return Bridge(Config.from_file(config_path), loop)
 
 
 def main():
@@ -701,16 +1005,47 @@ def main():
     Main function to get the entire ball rolling.
     """
     logging.basicConfig(level=logging.WARNING)
-    db.initialize(DATABASE_URL)
 
-    loop = asyncio.get_event_loop()
-    asyncio.ensure_future(TG_BOT.loop())
+    try:
+        bridge = create_bridge()
+    except ConfigError as exception:
+        print('Error opening config file:')
+        print(exception)
+        exit(1)
+
+    run(bridge)
+
 
-    app = web.Application(loop=loop)
-    app.router.add_route('GET', '/rooms/{room_alias}', matrix_room)
-    app.router.add_route('PUT', '/transactions/{transaction}',
-                         matrix_transaction)
-    web.run_app(app, port=AS_PORT)
+def run(bridge, host='0.0.0.0'):
+    """
+    Serve a bridge until SIGINT or SIGTERM, then shut it down gracefully.
+    :param bridge: The bridge to run.
+    :param host: The host to listen on.
+    """
+    loop = bridge.loop
+    app = bridge.make_app()
+    handler = app.make_handler()
+    server = loop.run_until_complete(
+        loop.create_server(handler, host, bridge.config.as_port))
+    bridge.start()
+
+    stopping = asyncio.Event(loop=loop)
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stopping.set)
+
+    print('======== Running on http://{}:{}/ ========'
+          .format(host, bridge.config.as_port))
+    try:
+        loop.run_until_complete(stopping.wait())
+    finally:
+        # Keep the server up while draining so new transactions get a 503.
+        loop.run_until_complete(bridge.lifecycle.shutdown())
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+        loop.run_until_complete(app.shutdown())
+        loop.run_until_complete(handler.finish_connections(1.0))
+        loop.run_until_complete(app.cleanup())
+    loop.close()
 
 
 if __name__ == "__main__":
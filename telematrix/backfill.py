@@ -0,0 +1,257 @@
+"""
+Catching up on Matrix events that were missed while the bridge was down.
+"""
+import asyncio
+from collections import Counter, OrderedDict
+from functools import partial
+
+import telematrix.database as db
+from telematrix.cache import LRUCache
+
+BRIDGED_TYPES = ('m.room.message', 'm.room.member')
+
+
+class Backfill:
+    """
+    Replays missed Matrix events to Telegram through the room queues. When
+    too many events were missed, only the latest ones are replayed and the
+    rest are summarized.
+
+    Events are only bridged once they run, so the IDs of queued events are
+    kept as well. Otherwise a redelivered event could be replayed or
+    summarized again before the first copy ran.
+
+    The homeserver delivers its backlog in many transactions, so stale events
+    are held per room until no more arrive for `stale_delay` seconds. That
+    way a gap is summarized once, not once per transaction.
+    """
+
+    def __init__(self, bridge, max_age=600000, page_size=100, max_pages=10,
+                 threshold=20, stale_delay=5, queued_size=10000):
+        # pylint: disable=too-many-arguments
+        self.bridge = bridge
+        self.max_age = max_age
+        self.page_size = page_size
+        self.max_pages = max_pages
+        self.threshold = threshold
+        self.stale_delay = stale_delay
+        self.user_id = None
+        self.queued = LRUCache(queued_size)
+        self._stale = {}
+        self._flushes = {}
+
+    def is_stale(self, event):
+        """Whether an event is too old to be bridged as a live event."""
+        return bool(self.max_age) and event.get('age', 0) > self.max_age
+
+    def add_stale(self, room_id, events):
+        """
+        Hold stale events of a room until the homeserver's backlog for it is
+        through, then replay them together.
+        :param room_id: The Matrix room.
+        :param events: The stale events, oldest first.
+        """
+        self._stale.setdefault(room_id, []).extend(events)
+        handle = self._flushes.pop(room_id, None)
+        if handle:
+            handle.cancel()
+        self._flushes[room_id] = self.bridge.loop.call_later(
+            self.stale_delay, self.flush, room_id)
+
+    def flush(self, room_id):
+        """
+        Replay the stale events held for a room now, e.g. because a live
+        event arrived that has to be bridged after them.
+        """
+        handle = self._flushes.pop(room_id, None)
+        if handle:
+            handle.cancel()
+        events = self._stale.pop(room_id, None)
+        if not events:
+            return
+
+        links = self.bridge.session.query(db.ChatLink)\
+                    .filter_by(matrix_room=room_id).all()
+        if not links:
+            print('{} isn\'t linked!'.format(room_id))
+            return
+        # The homeserver already got its answer, so these can't be refused.
+        self.queue(room_id, links, *self.plan(room_id, links, events))
+
+    def flush_all(self):
+        """Replay the stale events held for every room."""
+        for room_id in list(self._stale):
+            self.flush(room_id)
+
+    def mark_queued(self, event):
+        """Remember that an event was queued, so it isn't replayed again."""
+        self.queued.put(event['event_id'], True)
+
+    def is_handled(self, event):
+        """Whether an event was already queued, bridged or summarized."""
+        return event['event_id'] in self.queued \
+            or self.bridge.is_bridged(event) \
+            or self.bridge.session.query(db.SkippedEvent)\
+                   .filter_by(matrix_event_id=event['event_id']).first() is not None
+
+    async def catch_up(self):
+        """Bridge the events sent in every linked room since the last one."""
+        whoami = await self.bridge.matrix_get('client', 'account/whoami', None)
+        self.user_id = whoami.get('user_id')
+
+        rooms = {}
+        for link in self.bridge.session.query(db.ChatLink).all():
+            rooms.setdefault(link.matrix_room, []).append(link)
+
+        for room_id, links in rooms.items():
+            try:
+                await self.catch_up_room(room_id, links)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:  # pylint: disable=broad-except
+                print('Could not catch up on {}: {}'.format(room_id, e))
+
+    async def catch_up_room(self, room_id, links):
+        """
+        Bridge the events sent in a room since the last bridged event. The
+        room is read backwards from its end, so the latest events are the
+        ones replayed even if the gap is longer than max_pages.
+        :param room_id: The Matrix room.
+        :param links: The ChatLinks of the room.
+        """
+        last = self.bridge.session.query(db.Message)\
+                   .filter_by(matrix_room_id=room_id)\
+                   .order_by(db.Message.id.desc()).first()
+        if not last:
+            return
+
+        # The bridge's own user has to be in the room to read its timeline.
+        await self.bridge.matrix_post('client', 'join/{}'.format(room_id),
+                                      None, {})
+
+        events = []
+        token = None
+        found = False
+        truncated = False
+        for _ in range(self.max_pages):
+            params = {'dir': 'b', 'limit': self.page_size}
+            if token:
+                params['from'] = token
+            page = await self.bridge.matrix_get(
+                'client', 'rooms/{}/messages'.format(room_id), None, params)
+            if 'errcode' in page:
+                print('Could not read the timeline of {}: {}'
+                      .format(room_id, page['errcode']))
+                return
+
+            for event in page.get('chunk', []):
+                if event['event_id'] == last.matrix_event_id:
+                    found = True
+                    break
+                events.append(event)
+            if found or not page.get('chunk') or page['end'] == token:
+                break
+            token = page['end']
+        else:
+            # The last bridged event wasn't reached, so older events are missing
+            truncated = True
+
+        events.reverse()
+        if events:
+            print('Catching up on {}{} events in {}'
+                  .format('more than ' if truncated else '', len(events), room_id))
+        self.replay(room_id, links, events, truncated)
+
+    def plan(self, room_id, links, events, truncated=False):
+        """
+        Pick the missed events of a room to replay, summarizing the rest if
+        there are too many.
+        :param room_id: The Matrix room.
+        :param links: The ChatLinks of the room.
+        :param events: The missed events, oldest first.
+        :param truncated: Whether even older events were missed as well.
+        :return: A tuple of the picked events and the jobs to queue for them.
+        """
+        # Retried transactions can deliver the same event twice
+        events = list(OrderedDict((event['event_id'], event)
+                                  for event in events).values())
+        events = [event for event in events
+                  if event['type'] in BRIDGED_TYPES
+                  and not self.bridge.is_own_event(event)
+                  and not self.is_handled(event)]
+
+        for event in events:
+            # Timeline events only have a sender, transactions also a user_id
+            event.setdefault('user_id', event.get('sender'))
+
+        cut = max(0, len(events) - self.threshold)
+        skipped = Counter(event['user_id'] for event in events[:cut]
+                          if event['type'] == 'm.room.message')
+        skipped_ids = [event['event_id'] for event in events[:cut]]
+
+        tg_rooms = [link.tg_room for link in links]
+        jobs = []
+        if skipped_ids:
+            jobs.append(partial(self.send_summary, room_id, tg_rooms,
+                                skipped, skipped_ids, truncated))
+        for event in events[cut:]:
+            jobs.append(partial(self.bridge.handle_matrix_event, event,
+                                tg_rooms))
+        return events, jobs
+
+    def queue(self, room_id, links, events, jobs):
+        """
+        Queue the jobs returned by plan(), even if the room's queue is full.
+        Check can_accept() first where the events can still be refused.
+        """
+        options = self.bridge.queue_options(links[0])
+        for job in jobs:
+            self.bridge.scheduler.submit(room_id, job, force=True, **options)
+        for event in events:
+            self.mark_queued(event)
+
+    def replay(self, room_id, links, events, truncated=False):
+        """
+        Queue missed events of a room for bridging, summarizing them if there
+        are too many.
+        :param room_id: The Matrix room.
+        :param links: The ChatLinks of the room.
+        :param events: The missed events, oldest first.
+        :param truncated: Whether even older events were missed as well.
+        :return: Whether the events were queued.
+        """
+        events, jobs = self.plan(room_id, links, events, truncated)
+        if not self.bridge.scheduler.can_accept(
+                room_id, len(jobs), **self.bridge.queue_options(links[0])):
+            print('Queue for {} is full, not catching up'.format(room_id))
+            return False
+        self.queue(room_id, links, events, jobs)
+        return True
+
+    async def send_summary(self, room_id, tg_rooms, skipped, skipped_ids,
+                           truncated=False):
+        """
+        Tell the Telegram chats how many messages were skipped, per sender,
+        and remember the skipped events so they're never bridged later.
+        :param room_id: The Matrix room.
+        :param tg_rooms: The Telegram chats to tell.
+        :param skipped: A Counter of skipped messages per Matrix user.
+        :param skipped_ids: The IDs of all skipped events.
+        :param truncated: Whether even older events were skipped without
+                          being counted.
+        """
+        # pylint: disable=too-many-arguments
+        for event_id in skipped_ids:
+            self.bridge.session.add(db.SkippedEvent(room_id, event_id))
+        self.bridge.session.commit()
+        if not skipped:
+            return
+
+        senders = ', '.join('{}: {}'.format(self.bridge.matrix_displayname(user_id), count)
+                            for user_id, count in skipped.most_common())
+        msg = '> {}{} messages sent while the bridge was down were skipped ({})'\
+              .format('More than ' if truncated else '', sum(skipped.values()),
+                      senders)
+        await asyncio.gather(*[self.bridge.bot.group(tg_room).send_text(msg)
+                               for tg_room in tg_rooms],
+                             loop=self.bridge.loop, return_exceptions=True)
@@ -0,0 +1,33 @@
+"""
+A small in-memory LRU cache.
+"""
+from collections import OrderedDict
+
+
+class LRUCache:
+    """A mapping that forgets its least recently used entries."""
+
+    def __init__(self, size=1024):
+        self.size = size
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        """Get a value, marking it as recently used."""
+        try:
+            self._data.move_to_end(key)
+        except KeyError:
+            return default
+        return self._data[key]
+
+    def put(self, key, value):
+        """Store a value, evicting the least recently used one if full."""
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.size:
+            self._data.popitem(last=False)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
@@ -0,0 +1,74 @@
+"""
+Loads and holds the telematrix configuration.
+"""
+import json
+
+from telematrix.scheduler import POLICIES
+
+
+class ConfigError(Exception):
+    """Raised when the configuration is missing or incomplete."""
+
+
+class Config:
+    """The configuration of a single bridge instance."""
+    # pylint: disable=too-many-instance-attributes,too-few-public-methods
+
+    def __init__(self, obj):
+        try:
+            self.hs_token = obj['tokens']['hs']
+            self.as_token = obj['tokens']['as']
+            self.tg_token = obj['tokens']['telegram']
+
+            self.matrix_host = obj['hosts']['internal']
+            self.matrix_host_ext = obj['hosts']['external']
+            self.matrix_host_bare = obj['hosts']['bare']
+
+            self.user_id_format = obj['user_id_format']
+            self.database_url = obj['db_url']
+        except KeyError as exception:
+            raise ConfigError('Missing config key {}'.format(exception))
+
+        self.matrix_prefix = self.matrix_host + '_matrix/client/r0/'
+        self.matrix_media_prefix = self.matrix_host + '_matrix/media/r0/'
+
+        self.as_port = obj.get('as_port', 5000)
+        self.shutdown_timeout = obj.get('shutdown_timeout', 10)
+
+        queues = obj.get('queues', {})
+        self.queue_workers = queues.get('workers', 4)
+        self.queue_size = queues.get('size', 100)
+        self.queue_weight = queues.get('weight', 1)
+        self.queue_policy = queues.get('policy', 'shed_oldest')
+        if self.queue_policy not in POLICIES:
+            raise ConfigError('Unknown queue policy {}, expected one of {}'
+                              .format(self.queue_policy, ', '.join(POLICIES)))
+
+        links = obj.get('links', {})
+        self.link_backend = links.get('backend', 'none')
+        self.link_base_url = links.get('base_url', self.matrix_host_ext)
+        self.link_cache_size = links.get('cache_size', 1024)
+
+        self.media_cache_size = obj.get('media_cache_size', 1024)
+
+        catch_up = obj.get('catch_up', {})
+        self.catch_up = catch_up.get('enabled', True)
+        self.max_event_age = catch_up.get('max_event_age', 600000)
+        self.catch_up_page_size = catch_up.get('page_size', 100)
+        self.catch_up_max_pages = catch_up.get('max_pages', 10)
+        self.catch_up_threshold = catch_up.get('summary_threshold', 20)
+        self.catch_up_stale_delay = catch_up.get('stale_delay', 5)
+        self.raw = obj
+
+    @classmethod
+    def from_file(cls, path='config.json'):
+        """
+        Read the configuration from a JSON file.
+        :param path: The path of the configuration file.
+        :return: A Config.
+        """
+        try:
+            with open(path, 'r') as config_file:
+                return cls(json.load(config_file))
+        except (OSError, IOError, ValueError) as exception:
+            raise ConfigError(str(exception))
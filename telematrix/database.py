@@ -5,10 +5,8 @@ from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 import sqlalchemy as sa
 
-engine = None
 Base = declarative_base()
 Session = sessionmaker()
-session = None
 
 class ChatLink(Base):
     """Describes a link between the Telegram and Matrix side of the bridge."""
@@ -19,6 +17,12 @@ class ChatLink(Base):
     tg_room = sa.Column(sa.BigInteger)
     active = sa.Column(sa.Boolean)
 
+    # Overload protection for the room, see telematrix.scheduler. Left empty
+    # to use the defaults from the config.
+    queue_size = sa.Column(sa.Integer, nullable=True)
+    queue_weight = sa.Column(sa.Integer, nullable=True)
+    queue_policy = sa.Column(sa.String, nullable=True)
+
     def __init__(self, matrix_room, tg_room, active):
         self.matrix_room = matrix_room
         self.tg_room = tg_room
@@ -61,7 +65,7 @@ class Message(Base):
     tg_message_id = sa.Column(sa.BigInteger)
 
     matrix_room_id = sa.Column(sa.String)
-    matrix_event_id = sa.Column(sa.String)
+    matrix_event_id = sa.Column(sa.String, index=True)
 
     displayname = sa.Column(sa.String)
 
@@ -74,11 +78,77 @@ class Message(Base):
 
         self.displayname = displayname
 
-def initialize(*args, **kwargs):
-    """Initializes the database and creates tables if necessary."""
-    global engine, Base, Session, session
-    engine = sa.create_engine(*args, **kwargs)
-    Session.configure(bind=engine)
-    session = Session()
-    Base.metadata.bind = engine
-    Base.metadata.create_all()
+class SkippedEvent(Base):
+    """Describes a missed Matrix event that was summarized instead of bridged"""
+    __tablename__ = 'skipped_event'
+
+    id = sa.Column(sa.Integer, primary_key=True)
+    matrix_room_id = sa.Column(sa.String)
+    matrix_event_id = sa.Column(sa.String, index=True)
+
+    def __init__(self, matrix_room_id, matrix_event_id):
+        self.matrix_room_id = matrix_room_id
+        self.matrix_event_id = matrix_event_id
+
+class ShortLink(Base):
+    """Describes a link served by the bridge's own link shortener."""
+    __tablename__ = 'short_link'
+
+    id = sa.Column(sa.Integer, primary_key=True)
+    code = sa.Column(sa.String, index=True, unique=True)
+    url = sa.Column(sa.String, index=True)
+
+    def __init__(self, code, url):
+        self.code = code
+        self.url = url
+
+class MediaFile(Base):
+    """Describes a file that is known on both sides of the bridge."""
+    __tablename__ = 'media_file'
+
+    id = sa.Column(sa.Integer, primary_key=True)
+    mxc_url = sa.Column(sa.String, index=True)
+    tg_file_id = sa.Column(sa.String, index=True)
+    size = sa.Column(sa.Integer, nullable=True)
+
+    def __init__(self, mxc_url, tg_file_id, size=None):
+        self.mxc_url = mxc_url
+        self.tg_file_id = tg_file_id
+        self.size = size
+
+def add_missing_columns(bind):
+    """
+    Adds columns that were added to the models after their tables were
+    created. New columns must be nullable for this to work.
+    """
+    inspector = sa.inspect(bind)
+    for table in Base.metadata.sorted_tables:
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            bind.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(
+                table.name, column.name, column.type.compile(bind.dialect)))
+
+def add_missing_indexes(bind):
+    """
+    Adds indexes that were added to the models after their tables were
+    created.
+    """
+    inspector = sa.inspect(bind)
+    for table in Base.metadata.sorted_tables:
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(bind)
+
+def create_session(*args, **kwargs):
+    """
+    Creates an engine and a session bound to it, creating tables if
+    necessary. Every bridge instance gets its own session this way.
+    """
+    bind = sa.create_engine(*args, **kwargs)
+    Base.metadata.create_all(bind)
+    add_missing_columns(bind)
+    add_missing_indexes(bind)
+    return Session(bind=bind)
@@ -0,0 +1,101 @@
+"""
+Lifecycle management: keeps track of in-flight work so the bridge can shut
+down without dropping messages.
+"""
+import asyncio
+import functools
+
+
+class Lifecycle:
+    """
+    Tracks in-flight handlers of a bridge and drains them on shutdown.
+
+    Shutting down happens in this order: stop accepting Telegram updates,
+    answer new homeserver transactions with 503 so they are retried, wait for
+    in-flight handlers and queued work until the deadline, flush the database
+    and close the connections.
+    """
+
+    def __init__(self, bridge, timeout=10):
+        self.bridge = bridge
+        self.timeout = timeout
+        self.draining = False
+        self.tasks = []
+        self._in_flight = 0
+        self._idle = asyncio.Event(loop=bridge.loop)
+        self._idle.set()
+
+    @property
+    def in_flight(self):
+        """The number of handlers that are currently running."""
+        return self._in_flight
+
+    def tracked(self, handler):
+        """
+        Wrap a coroutine function so that calls to it are waited for on
+        shutdown.
+        :param handler: The coroutine function to wrap.
+        :return: The wrapped coroutine function.
+        """
+        @functools.wraps(handler)
+        async def wrapper(*args, **kwargs):
+            self._in_flight += 1
+            self._idle.clear()
+            try:
+                return await handler(*args, **kwargs)
+            finally:
+                self._in_flight -= 1
+                if not self._in_flight:
+                    self._idle.set()
+        return wrapper
+
+    def start(self, coro):
+        """
+        Run a background coroutine that is cancelled on shutdown.
+        :param coro: The coroutine to run.
+        :return: The task.
+        """
+        task = asyncio.ensure_future(coro, loop=self.bridge.loop)
+        self.tasks.append(task)
+        return task
+
+    async def _wait_idle(self):
+        await self._idle.wait()
+        await self.bridge.scheduler.join()
+
+    async def drain(self):
+        """
+        Stop accepting new work and wait for in-flight handlers and queued
+        work to finish.
+        :return: Whether everything finished before the deadline.
+        """
+        self.draining = True
+        self.bridge.bot.stop()
+        self.bridge.backfill.flush_all()
+
+        try:
+            await asyncio.wait_for(self._wait_idle(), self.timeout,
+                                   loop=self.bridge.loop)
+            drained = True
+        except asyncio.TimeoutError:
+            print('Shutdown deadline passed with {} handlers in flight'
+                  .format(self._in_flight))
+            drained = False
+
+        # Telegram only confirms updates on the next poll, so updates from an
+        # interrupted long poll are delivered again after the restart.
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, loop=self.bridge.loop,
+                             return_exceptions=True)
+        return drained
+
+    async def shutdown(self):
+        """Drain in-flight work, flush the database and close connections."""
+        await self.drain()
+        try:
+            self.bridge.session.commit()
+        except Exception as exception:  # pylint: disable=broad-except
+            print('Could not flush the database on shutdown:', exception)
+            self.bridge.session.rollback()
+        await self.bridge.close()
@@ -0,0 +1,127 @@
+"""
+Link shortening for media URLs sent to Telegram.
+"""
+import random
+import string
+
+from aiohttp import web
+
+import telematrix.database as db
+from telematrix.cache import LRUCache
+
+ALPHABET = string.digits + string.ascii_letters
+
+# Codes are random rather than derived from row IDs, so the links to media
+# from private rooms can't be found by counting. 12 digits are ~71 bits.
+CODE_LENGTH = 12
+
+_random = random.SystemRandom()
+
+
+def make_code():
+    """Make a random short code."""
+    return ''.join(_random.choice(ALPHABET) for _ in range(CODE_LENGTH))
+
+
+def is_code(code):
+    """Whether a string could be a short code."""
+    return len(code) == CODE_LENGTH and all(char in ALPHABET for char in code)
+
+
+class LinkShortener:
+    """Doesn't shorten anything. Base class of the other shorteners."""
+    enabled = False
+
+    async def shorten(self, url):
+        """
+        Shorten an URL.
+        :param url: The URL to shorten.
+        :return: The shortened URL.
+        """
+        return url
+
+    def add_routes(self, app):
+        """Add the routes this shortener needs to the application."""
+        pass
+
+
+class LocalShortener(LinkShortener):
+    """
+    Shortens links to a redirect served by the bridge itself. Links are
+    stored in the database so they survive restarts.
+    """
+    enabled = True
+
+    def __init__(self, session, base_url, cache_size=1024):
+        self.session = session
+        self.base_url = base_url.rstrip('/') + '/_telematrix/l/'
+        self._codes = LRUCache(cache_size)
+        self._urls = LRUCache(cache_size)
+
+    async def shorten(self, url):
+        code = self._codes.get(url)
+        if code is None:
+            link = self.session.query(db.ShortLink).filter_by(url=url).first()
+            if not link or not link.code:
+                # Links from before codes were random get a new code as well
+                code = self._unused_code()
+                if link:
+                    link.code = code
+                else:
+                    self.session.add(db.ShortLink(code, url))
+                self.session.commit()
+            else:
+                code = link.code
+            self._codes.put(url, code)
+            self._urls.put(code, url)
+        return self.base_url + code
+
+    def _unused_code(self):
+        code = make_code()
+        while self.session.query(db.ShortLink).filter_by(code=code).first():
+            code = make_code()
+        return code
+
+    def lookup(self, code):
+        """
+        Find the URL a short code points to.
+        :param code: The short code.
+        :return: The URL, or None if the code is unknown.
+        """
+        url = self._urls.get(code)
+        if url is None:
+            if not is_code(code):
+                return None
+            link = self.session.query(db.ShortLink).filter_by(code=code).first()
+            if not link:
+                return None
+            url = link.url
+            self._codes.put(url, code)
+            self._urls.put(code, url)
+        return url
+
+    async def redirect(self, request):
+        """Redirect a short link to its URL."""
+        url = self.lookup(request.match_info['code'])
+        if url is None:
+            raise web.HTTPNotFound()
+        raise web.HTTPFound(url)
+
+    def add_routes(self, app):
+        app.router.add_route('GET', '/_telematrix/l/{code}', self.redirect)
+
+
+def create_shortener(config, session):
+    """
+    Create the link shortener chosen in the configuration.
+    :param config: The Config of the bridge.
+    :param session: The database session of the bridge.
+    :return: A LinkShortener.
+    """
+    if config.link_backend == 'local':
+        return LocalShortener(session, config.link_base_url,
+                              config.link_cache_size)
+    if config.link_backend != 'none':
+        print('Unknown link shortener {}, not shortening links'
+              .format(config.link_backend))
+    return LinkShortener()
@@ -0,0 +1,76 @@
+"""
+Remembers which Matrix media and Telegram files have the same content, so
+media don't have to be transferred again.
+"""
+import telematrix.database as db
+from telematrix.cache import LRUCache
+
+
+class MediaCache:
+    """
+    Maps MXC URLs to Telegram file IDs and back. Changes are only added to
+    the session, to be committed by the handler that made them.
+    """
+
+    def __init__(self, session, size=1024):
+        self.session = session
+        self._file_ids = LRUCache(size)
+        self._mxc_urls = LRUCache(size)
+
+    def _remember(self, media):
+        self._file_ids.put(media.mxc_url, media.tg_file_id)
+        self._mxc_urls.put(media.tg_file_id, (media.mxc_url, media.size))
+
+    def file_id(self, mxc_url):
+        """
+        Find the Telegram file with the same content as a Matrix file.
+        :param mxc_url: The MXC URL of the Matrix file.
+        :return: The Telegram file ID, or None if unknown.
+        """
+        file_id = self._file_ids.get(mxc_url)
+        if file_id is None:
+            media = self.session.query(db.MediaFile)\
+                        .filter_by(mxc_url=mxc_url).first()
+            if not media:
+                return None
+            self._remember(media)
+            file_id = media.tg_file_id
+        return file_id
+
+    def mxc_url(self, file_id):
+        """
+        Find the Matrix file with the same content as a Telegram file.
+        :param file_id: The Telegram file ID.
+        :return: A tuple of the MXC URL and the size, or (None, 0) if unknown.
+        """
+        found = self._mxc_urls.get(file_id)
+        if found is None:
+            media = self.session.query(db.MediaFile)\
+                        .filter_by(tg_file_id=file_id).first()
+            if not media:
+                return None, 0
+            self._remember(media)
+            found = media.mxc_url, media.size
+        return found
+
+    def add(self, mxc_url, file_id, size=None):
+        """
+        Remember that a Matrix file and a Telegram file have the same content.
+        :param mxc_url: The MXC URL of the Matrix file.
+        :param file_id: The Telegram file ID.
+        :param size: The size of the file in bytes, if known.
+        """
+        media = self.session.query(db.MediaFile)\
+                    .filter_by(mxc_url=mxc_url, tg_file_id=file_id).first()
+        if not media:
+            media = db.MediaFile(mxc_url, file_id, size)
+            self.session.add(media)
+        self._remember(media)
+
+    def forget(self, file_id):
+        """Forget a Telegram file, e.g. because Telegram no longer knows it."""
+        for media in self.session.query(db.MediaFile)\
+                         .filter_by(tg_file_id=file_id).all():
+            self.session.delete(media)
+            self._file_ids.put(media.mxc_url, None)
+        self._mxc_urls.put(file_id, None)
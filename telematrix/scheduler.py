@@ -0,0 +1,217 @@
+"""
+Fair scheduling of inbound work, so one busy room can't starve the others.
+"""
+import asyncio
+import traceback
+from collections import deque
+
+SHED_OLDEST = 'shed_oldest'
+COALESCE = 'coalesce'
+REJECT = 'reject'
+
+POLICIES = (SHED_OLDEST, COALESCE, REJECT)
+
+
+class QueueFull(Exception):
+    """Raised when a job is rejected because its room's queue is full."""
+
+
+class RoomQueue:
+    """The bounded queue of pending jobs for a single room."""
+    # pylint: disable=too-many-instance-attributes,too-few-public-methods
+
+    def __init__(self, size, weight, policy):
+        self.jobs = deque()
+        self.size = max(1, size)
+        self.weight = max(1, weight)
+        self.policy = policy
+        self.credit = self.weight
+        self.busy = False
+
+        self.enqueued = 0
+        self.dispatched = 0
+        self.shed = 0
+        self.coalesced = 0
+        self.rejected = 0
+        self.failed = 0
+
+    def configure(self, size, weight, policy):
+        """
+        Update the limits of the queue, e.g. after a link changed. The policy
+        must be one of POLICIES.
+        """
+        self.size = max(1, size)
+        weight = max(1, weight)
+        if weight != self.weight:
+            self.weight = weight
+            self.credit = weight
+        self.policy = policy
+
+    def stats(self):
+        """The current state and counters of the queue."""
+        return {'queued': len(self.jobs), 'busy': self.busy,
+                'size': self.size, 'weight': self.weight,
+                'policy': self.policy, 'enqueued': self.enqueued,
+                'dispatched': self.dispatched, 'shed': self.shed,
+                'coalesced': self.coalesced, 'rejected': self.rejected,
+                'failed': self.failed}
+
+
+class Scheduler:
+    """
+    Runs jobs from per-room queues on a fixed number of workers.
+
+    Jobs of one room run one at a time and in order. Rooms with pending jobs
+    take turns, and a room with weight n runs up to n jobs per turn.
+    """
+
+    def __init__(self, loop, workers=4, size=100, weight=1,
+                 policy=SHED_OLDEST):
+        # pylint: disable=too-many-arguments
+        self.loop = loop
+        self.workers = workers
+        self.size = size
+        self.weight = weight
+        self.policy = policy
+        self.rooms = {}
+
+        self._ring = deque()
+        self._ready = asyncio.Semaphore(0, loop=loop)
+        self._pending = 0
+        self._idle = asyncio.Event(loop=loop)
+        self._idle.set()
+
+    def _room(self, key, size=None, weight=None, policy=None):
+        size = size or self.size
+        weight = weight or self.weight
+        policy = policy or self.policy
+        room = self.rooms.get(key)
+        if room is None:
+            room = RoomQueue(size, weight, policy)
+            self.rooms[key] = room
+        else:
+            room.configure(size, weight, policy)
+        return room
+
+    def _push(self, key, front=False):
+        if front:
+            self._ring.appendleft(key)
+        else:
+            self._ring.append(key)
+        self._ready.release()
+
+    def can_accept(self, key, count=1, size=None, weight=None, policy=None):
+        """
+        Check whether `count` jobs for a room would be accepted right now.
+        Only rooms with the reject policy ever refuse jobs, and never when
+        their queue is empty, so a batch larger than the queue can't be
+        refused forever. Submit an accepted batch with force=True.
+        """
+        # pylint: disable=too-many-arguments
+        room = self._room(key, size, weight, policy)
+        return room.policy != REJECT or not room.jobs \
+            or len(room.jobs) + count <= room.size
+
+    def submit(self, key, job, coalesce_key=None, size=None, weight=None,
+               policy=None, force=False):
+        """
+        Queue a job for a room.
+        :param key: The room the job belongs to.
+        :param job: A coroutine function taking no arguments.
+        :param coalesce_key: When the room's queue is full and it uses the
+                             coalesce policy, a waiting job with the same
+                             key is dropped instead of the oldest one.
+        :param size: The maximum number of queued jobs for the room.
+        :param weight: The number of jobs the room may run per turn.
+        :param policy: What to do when the room's queue is full.
+        :param force: Queue the job even if the room rejects jobs and its
+                      queue is full, because can_accept() allowed its batch.
+        :raises QueueFull: If the room rejects jobs and its queue is full.
+        """
+        # pylint: disable=too-many-arguments
+        room = self._room(key, size, weight, policy)
+        # The room is already waiting for a turn unless it was idle.
+        idle = not room.jobs and not room.busy
+
+        if len(room.jobs) >= room.size:
+            if room.policy != REJECT:
+                if not self._coalesce(room, coalesce_key):
+                    room.jobs.popleft()
+                    room.shed += 1
+                self._pending -= 1
+            elif not force:
+                room.rejected += 1
+                raise QueueFull(key)
+
+        room.jobs.append((coalesce_key, job))
+        room.enqueued += 1
+        self._pending += 1
+        self._idle.clear()
+        if idle:
+            self._push(key)
+
+    @staticmethod
+    def _coalesce(room, coalesce_key):
+        """
+        Drop a waiting job with the same coalesce key, so the new one is
+        queued behind everything that was submitted before it.
+        :return: Whether a job was dropped.
+        """
+        if coalesce_key is None or room.policy != COALESCE:
+            return False
+        for i, (other_key, _) in enumerate(room.jobs):
+            if other_key == coalesce_key:
+                del room.jobs[i]
+                room.coalesced += 1
+                return True
+        return False
+
+    async def worker(self):
+        """Run jobs until cancelled."""
+        while True:
+            await self._ready.acquire()
+            key = self._ring.popleft()
+            room = self.rooms[key]
+            if not room.jobs:
+                # A stray turn must not kill the worker.
+                continue
+            _, job = room.jobs.popleft()
+            room.busy = True
+            room.dispatched += 1
+            try:
+                await job()
+            except asyncio.CancelledError:
+                raise
+            except Exception:  # pylint: disable=broad-except
+                room.failed += 1
+                print('Error while handling a job for {}:'.format(key))
+                traceback.print_exc()
+            finally:
+                room.busy = False
+                self._done(key, room)
+
+    def _done(self, key, room):
+        self._pending -= 1
+        if not self._pending:
+            self._idle.set()
+
+        if not room.jobs:
+            room.credit = room.weight
+            return
+        room.credit -= 1
+        if room.credit > 0:
+            self._push(key, front=True)
+        else:
+            room.credit = room.weight
+            self._push(key)
+
+    async def join(self):
+        """Wait until all queued jobs have run."""
+        await self._idle.wait()
+
+    def stats(self):
+        """
+        The state of every room queue, for monitoring.
+        :return: A dict from room to its queue stats.
+        """
+        return {str(key): room.stats() for key, room in self.rooms.items()}
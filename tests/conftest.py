@@ -0,0 +1,26 @@
+"""
+Fixtures shared by the tests.
+"""
+import asyncio
+
+import pytest
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.fixture
+def run(loop):
+    """A function running a scheduler until all queued jobs are done."""
+    def run_scheduler(scheduler, workers=1):
+        tasks = [loop.create_task(scheduler.worker()) for _ in range(workers)]
+        loop.run_until_complete(scheduler.join())
+        for task in tasks:
+            task.cancel()
+        loop.run_until_complete(asyncio.gather(*tasks, loop=loop,
+                                               return_exceptions=True))
+    return run_scheduler
@@ -0,0 +1,152 @@
+"""
+Tests for replaying missed Matrix events.
+"""
+import asyncio
+from functools import partial
+
+import telematrix.database as db
+from telematrix.backfill import Backfill
+from telematrix.scheduler import Scheduler, REJECT
+
+
+class FakeGroup:
+    def __init__(self, sent, tg_room):
+        self.sent = sent
+        self.tg_room = tg_room
+
+    async def send_text(self, text):
+        self.sent.append((self.tg_room, text))
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    def group(self, tg_room):
+        return FakeGroup(self.sent, tg_room)
+
+
+class FakeBridge:
+    """Just enough of a Bridge to replay events."""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.session = db.create_session('sqlite://')
+        self.scheduler = Scheduler(loop)
+        self.bot = FakeBot()
+
+    def queue_options(self, _link):
+        return {}
+
+    def is_own_event(self, _event):
+        return False
+
+    def is_bridged(self, event):
+        return self.session.query(db.Message)\
+                   .filter_by(matrix_event_id=event['event_id']).first() is not None
+
+    def matrix_displayname(self, user_id):
+        return user_id
+
+    async def matrix_post(self, *_args):
+        return {}
+
+    async def matrix_get(self, _category, _path, _user_id, params):
+        """Page backwards through a timeline of 100 events."""
+        end = int(params.get('from', 100))
+        start = max(0, end - params['limit'])
+        timeline = make_events(100)
+        for event in timeline:
+            event['sender'] = event.pop('user_id')
+        return {'chunk': timeline[start:end][::-1], 'end': str(start)}
+
+    async def handle_matrix_event(self, event, tg_rooms):
+        for tg_room in tg_rooms:
+            await self.bot.group(tg_room).send_text(event['content']['body'])
+            self.session.add(db.Message(tg_room, 1, event['room_id'],
+                                        event['event_id'], ''))
+        self.session.commit()
+
+
+def make_events(count):
+    return [{'type': 'm.room.message', 'room_id': '!r', 'user_id': '@u',
+             'event_id': '$e{}'.format(i), 'content': {'body': 'hi {}'.format(i)}}
+            for i in range(count)]
+
+
+def test_summarizes_once(loop, run):
+    bridge = FakeBridge(loop)
+    backfill = Backfill(bridge, threshold=2)
+    links = [db.ChatLink('!r', 1, True)]
+
+    backfill.replay('!r', links, make_events(4))
+    # The homeserver redelivers before the first replay ran...
+    backfill.replay('!r', links, make_events(4))
+    run(bridge.scheduler)
+    # ...and once more after it ran and the bridge restarted.
+    backfill = Backfill(bridge, threshold=2)
+    backfill.replay('!r', links, make_events(4))
+    run(bridge.scheduler)
+
+    texts = [text for _, text in bridge.bot.sent]
+    assert len(texts) == 3
+    assert 'skipped' in texts[0]
+    assert texts[1:] == ['hi 2', 'hi 3']
+
+
+def test_full_queue_replays_nothing(loop, run):
+    bridge = FakeBridge(loop)
+    bridge.scheduler = Scheduler(loop, size=2, policy=REJECT)
+    backfill = Backfill(bridge, threshold=2)
+    links = [db.ChatLink('!r', 1, True)]
+    bridge.scheduler.submit('!r', partial(bridge.bot.group(1).send_text, 'busy'))
+
+    # A summary and two events don't fit, so none of them may be queued...
+    assert not backfill.replay('!r', links, make_events(4))
+    assert bridge.scheduler.rooms['!r'].enqueued == 1
+    run(bridge.scheduler)
+    # ...and none may count as handled, so a retry still replays them.
+    assert backfill.replay('!r', links, make_events(2))
+    run(bridge.scheduler)
+    assert [text for _, text in bridge.bot.sent] == ['busy', 'hi 0', 'hi 1']
+
+
+def catch_up(loop, run, last, **kwargs):
+    bridge = FakeBridge(loop)
+    bridge.session.add(db.Message(1, 1, '!r', '$e{}'.format(last), ''))
+    bridge.session.commit()
+    backfill = Backfill(bridge, threshold=2, **kwargs)
+    loop.run_until_complete(
+        backfill.catch_up_room('!r', [db.ChatLink('!r', 1, True)]))
+    run(bridge.scheduler)
+    return [text for _, text in bridge.bot.sent]
+
+
+def test_catch_up(loop, run):
+    texts = catch_up(loop, run, 94, page_size=4)
+    assert texts == ['> 3 messages sent while the bridge was down were '
+                     'skipped (@u: 3)', 'hi 98', 'hi 99']
+
+
+def test_catch_up_replays_latest_of_long_gap(loop, run):
+    texts = catch_up(loop, run, 10, page_size=10, max_pages=3)
+    assert texts[0].startswith('> More than 28 messages')
+    assert texts[1:] == ['hi 98', 'hi 99']
+
+
+def test_stale_transactions_are_summarized_once(loop, run):
+    bridge = FakeBridge(loop)
+    bridge.session.add(db.ChatLink('!r', 1, True))
+    bridge.session.commit()
+    backfill = Backfill(bridge, threshold=2, stale_delay=0.01)
+
+    events = make_events(8)
+    backfill.add_stale('!r', events[:4])
+    backfill.add_stale('!r', events[2:])
+    assert '!r' not in bridge.scheduler.rooms
+    loop.run_until_complete(asyncio.sleep(0.05, loop=loop))
+    run(bridge.scheduler)
+
+    texts = [text for _, text in bridge.bot.sent]
+    assert texts == ['> 6 messages sent while the bridge was down were '
+                     'skipped (@u: 6)', 'hi 6', 'hi 7']
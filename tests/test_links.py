@@ -0,0 +1,55 @@
+"""
+Tests for the link shortener.
+"""
+import telematrix.database as db
+from telematrix.links import LocalShortener, make_code, is_code, CODE_LENGTH
+
+
+def make_shortener(session):
+    return LocalShortener(session, 'https://bridge.example/')
+
+
+def code_of(link):
+    return link.rsplit('/', 1)[1]
+
+
+def test_codes_are_random():
+    codes = {make_code() for _ in range(100)}
+    assert len(codes) == 100
+    assert all(is_code(code) for code in codes)
+
+
+def test_is_code():
+    assert not is_code('1')
+    assert not is_code('a' * (CODE_LENGTH + 1))
+    assert not is_code('-' * CODE_LENGTH)
+    assert not is_code('9' * 1000)
+
+
+def test_shorten_and_lookup(loop):
+    session = db.create_session('sqlite://')
+    shortener = make_shortener(session)
+    link = loop.run_until_complete(shortener.shorten('https://a.example/x'))
+    assert link.startswith('https://bridge.example/_telematrix/l/')
+    assert loop.run_until_complete(shortener.shorten('https://a.example/x')) == link
+
+    # Links survive a restart.
+    assert make_shortener(session).lookup(code_of(link)) == 'https://a.example/x'
+
+
+def test_links_are_not_row_ids(loop):
+    session = db.create_session('sqlite://')
+    shortener = make_shortener(session)
+    loop.run_until_complete(shortener.shorten('https://a.example/x'))
+    assert shortener.lookup('1') is None
+    assert shortener.lookup('0' * (CODE_LENGTH - 1) + '1') is None
+
+
+def test_old_links_get_a_code(loop):
+    session = db.create_session('sqlite://')
+    session.add(db.ShortLink(None, 'https://a.example/x'))
+    session.commit()
+    shortener = make_shortener(session)
+    link = loop.run_until_complete(shortener.shorten('https://a.example/x'))
+    assert is_code(code_of(link))
+    assert session.query(db.ShortLink).count() == 1
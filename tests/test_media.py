@@ -0,0 +1,49 @@
+"""
+Tests for the media cache.
+"""
+import telematrix.database as db
+from telematrix.media import MediaCache
+
+
+def test_add_and_lookup():
+    session = db.create_session('sqlite://')
+    media = MediaCache(session)
+    assert media.file_id('mxc://a/b') is None
+    assert media.mxc_url('F1') == (None, 0)
+
+    media.add('mxc://a/b', 'F1', 42)
+    assert media.file_id('mxc://a/b') == 'F1'
+    assert media.mxc_url('F1') == ('mxc://a/b', 42)
+
+
+def test_add_leaves_commit_to_caller():
+    session = db.create_session('sqlite://')
+    MediaCache(session).add('mxc://a/b', 'F1', 42)
+    assert session.new
+    session.commit()
+
+    # A new cache finds the file in the database.
+    media = MediaCache(session)
+    assert media.file_id('mxc://a/b') == 'F1'
+    assert media.mxc_url('F1') == ('mxc://a/b', 42)
+
+
+def test_add_twice():
+    session = db.create_session('sqlite://')
+    media = MediaCache(session)
+    media.add('mxc://a/b', 'F1')
+    media.add('mxc://a/b', 'F1')
+    session.commit()
+    assert session.query(db.MediaFile).count() == 1
+
+
+def test_forget():
+    session = db.create_session('sqlite://')
+    media = MediaCache(session)
+    media.add('mxc://a/b', 'F1', 42)
+    session.commit()
+    media.forget('F1')
+    session.commit()
+    assert media.file_id('mxc://a/b') is None
+    assert media.mxc_url('F1') == (None, 0)
+    assert MediaCache(session).file_id('mxc://a/b') is None
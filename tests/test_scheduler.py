@@ -0,0 +1,132 @@
+"""
+Tests for the fair per-room scheduler.
+"""
+import asyncio
+
+import pytest
+
+from telematrix.scheduler import Scheduler, QueueFull, COALESCE, REJECT
+
+
+def make_job(order, name):
+    async def job():
+        order.append(name)
+        await asyncio.sleep(0)
+    return job
+
+
+def test_order_within_room(loop, run):
+    order = []
+    scheduler = Scheduler(loop, workers=4)
+    for i in range(5):
+        scheduler.submit('a', make_job(order, i))
+    run(scheduler, workers=4)
+    assert order == [0, 1, 2, 3, 4]
+
+
+def test_rooms_take_turns(loop, run):
+    order = []
+    scheduler = Scheduler(loop)
+    for i in range(3):
+        scheduler.submit('a', make_job(order, 'a{}'.format(i)))
+    for i in range(3):
+        scheduler.submit('b', make_job(order, 'b{}'.format(i)))
+    run(scheduler)
+    assert order == ['a0', 'b0', 'a1', 'b1', 'a2', 'b2']
+
+
+def test_weighted_turns(loop, run):
+    order = []
+    scheduler = Scheduler(loop)
+    for i in range(4):
+        scheduler.submit('a', make_job(order, 'a{}'.format(i)), weight=2)
+    for i in range(2):
+        scheduler.submit('b', make_job(order, 'b{}'.format(i)))
+    run(scheduler)
+    assert order == ['a0', 'a1', 'b0', 'a2', 'a3', 'b1']
+
+
+def test_shed_oldest(loop, run):
+    order = []
+    scheduler = Scheduler(loop, size=2)
+    for i in range(4):
+        scheduler.submit('a', make_job(order, i))
+    assert scheduler.rooms['a'].shed == 2
+    assert scheduler._pending == 2
+    run(scheduler)
+    assert order == [2, 3]
+    assert scheduler._pending == 0
+
+
+def test_shed_size_one(loop, run):
+    order = []
+    scheduler = Scheduler(loop, size=1)
+    scheduler.submit('a', make_job(order, 0))
+    scheduler.submit('a', make_job(order, 1))
+    assert list(scheduler._ring) == ['a']
+    run(scheduler)
+    scheduler.submit('a', make_job(order, 2))
+    run(scheduler)
+    assert order == [1, 2]
+    assert scheduler._pending == 0
+
+
+def test_coalesce(loop, run):
+    order = []
+    scheduler = Scheduler(loop, size=2, policy=COALESCE)
+    scheduler.submit('a', make_job(order, 'join'), ('member', '@u'))
+    scheduler.submit('a', make_job(order, 'text'))
+    scheduler.submit('a', make_job(order, 'leave'), ('member', '@u'))
+    assert scheduler.rooms['a'].coalesced == 1
+    scheduler.submit('a', make_job(order, 'more'))
+    assert scheduler.rooms['a'].shed == 1
+    run(scheduler)
+    assert order == ['leave', 'more']
+
+
+def test_coalesce_only_when_full(loop, run):
+    order = []
+    scheduler = Scheduler(loop, policy=COALESCE)
+    scheduler.submit('a', make_job(order, 'join'), ('member', '@u'))
+    scheduler.submit('a', make_job(order, 'text'))
+    scheduler.submit('a', make_job(order, 'leave'), ('member', '@u'))
+    assert scheduler.rooms['a'].coalesced == 0
+    run(scheduler)
+    assert order == ['join', 'text', 'leave']
+
+
+def test_reject(loop, run):
+    order = []
+    scheduler = Scheduler(loop, size=1, policy=REJECT)
+    scheduler.submit('a', make_job(order, 0))
+    assert not scheduler.can_accept('a')
+    with pytest.raises(QueueFull):
+        scheduler.submit('a', make_job(order, 1))
+    assert scheduler.rooms['a'].rejected == 1
+    run(scheduler)
+    assert order == [0]
+
+
+def test_failing_job_doesnt_stop_worker(loop, run):
+    order = []
+
+    async def fail():
+        raise ValueError('boom')
+
+    scheduler = Scheduler(loop)
+    scheduler.submit('a', fail)
+    scheduler.submit('a', make_job(order, 'after'))
+    run(scheduler)
+    assert order == ['after']
+    assert scheduler.rooms['a'].failed == 1
+
+
+def test_reject_accepts_batch_when_empty(loop, run):
+    order = []
+    scheduler = Scheduler(loop, size=1, policy=REJECT)
+    assert scheduler.can_accept('a', 3)
+    for i in range(3):
+        scheduler.submit('a', make_job(order, i), force=True)
+    assert not scheduler.can_accept('a', 1)
+    run(scheduler)
+    assert order == [0, 1, 2]